@@ -0,0 +1,236 @@
+import argparse
+import io
+import json
+import os
+import sqlite3
+import tarfile
+import time
+from functools import partial
+from multiprocessing import Pool
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp'}
+MANIFEST_FILE = 'manifest.sqlite'
+INDEX_FILE = 'index.tsv'
+INDEX_COLUMNS = ('key', 'label', 'shard', 'image_ext', 'image_offset', 'image_size', 'json_offset', 'json_size')
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Dataset export',
+        description='Pack image directories into fixed-size tar shards with a json sidecar per image and an offset index')
+    parser.add_argument('-r', '--dirs_root', type=str, default='', help='Root path for --dirs')
+    parser.add_argument('-d', '--dirs', nargs='+', required=True,
+        help='Image directories, located in --dirs_root, the name of a directory is the label of its images')
+    parser.add_argument('-o', '--output', type=str, default='shards', help='Directory the shards and the index are written to')
+    parser.add_argument('--shard_size', type=float, default=256, help='Max size of a shard in MB')
+    parser.add_argument('--include', type=str, default=None,
+        help='File with line separated image paths, only these images are exported (e.g. isolated.txt of isolatedfilter.py)')
+    parser.add_argument('--exclude', type=str, default=None, help='File with line separated image paths that are not exported')
+    parser.add_argument('--resize', type=int, default=None, help='Downscale the images so their longest side is at most this size')
+    parser.add_argument('--quality', type=int, default=None, help='Re-encode the images as jpeg with this quality (1-100)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes resizing and re-encoding the images')
+    parser.add_argument('--chunksize', type=int, default=16, help='Number of images sent to a process at once')
+    args = parser.parse_args()
+    return args
+
+
+def list_images(directory):
+    # recursive, the download script can shard a directory in sub directories
+    images = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                images.append(os.path.relpath(os.path.join(root, name), directory))
+    return sorted(images)
+
+
+def read_paths(paths_file):
+    with open(paths_file) as p:
+        return {os.path.abspath(line.rstrip()) for line in p if line.strip()}
+
+
+def read_manifest(directory):
+    """Source url, engine, query and sha256 of the images recorded in the manifest of the download script, by relative path"""
+    manifest_file = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.isfile(manifest_file):
+        return {}
+    connection = sqlite3.connect(f'file:{manifest_file}?mode=ro', uri=True)
+    try:
+        rows = connection.execute('SELECT file_name, url, engine, query, sha256 FROM files').fetchall()
+    finally:
+        connection.close()
+    return {os.path.normpath(file_name): {'url': url, 'engine': engine, 'query': query, 'sha256': sha256}
+            for file_name, url, engine, query, sha256 in rows}
+
+
+def parse_file_name(file_name):
+    # images downloaded before the manifest: {position}_{engine}_{query with underscores}_{sequence}.jpg, the url is unknown.
+    # position is the index of the query among the comma separated queries of its line, not the line number,
+    # and sequence the number of the image among the images of the query
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    parts = name.split('_', 2)
+    if len(parts) < 3 or not parts[0].isdigit():
+        return {'url': None, 'engine': None, 'query': None}
+    query = parts[2].rpartition('_')[0]
+    return {'url': None, 'engine': parts[1], 'query': query.replace('_', ' ') or None}
+
+
+def load_image(path, resize, quality):
+    """Reads an image, downscaled and re-encoded as jpeg when resize or quality is set
+
+    Returns (path, data, ext, size) with ext the extension of the data, the one of the file when it is copied,
+    and size (width, height) of a re-encoded image. data is None when the image can not be read
+    """
+    if resize is None and quality is None:
+        with open(path, 'rb') as f:
+            return path, f.read(), os.path.splitext(path)[1].lower(), None
+    import cv2
+    image = cv2.imread(path)
+    if image is None:  # corrupt or missing file
+        return path, None, None, None
+    height, width = image.shape[:2]
+    if resize is not None and max(height, width) > resize:
+        scale = resize / max(height, width)
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    ok, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality if quality is not None else 95])
+    if not ok:
+        return path, None, None, None
+    return path, data.tobytes(), '.jpg', (width, height)
+
+
+class ShardWriter:
+    """Writes the samples of a label to {label}-000000.tar, {label}-000001.tar, ... of at most shard_size bytes.
+
+    A sample is two members sharing a key, the image {key}.jpg (or the extension of the copied file, e.g. {key}.png)
+    and {key}.json, next to each other in the shard.
+    The shards are written to a temporary file and renamed once complete, a shard is never larger than shard_size
+    unless it holds a single sample bigger than that.
+    """
+    def __init__(self, output, label, shard_size, index):
+        self.output = output
+        self.label = label
+        self.shard_size = shard_size
+        self.index = index
+        self.shard = -1
+        self.tar = None
+        self.keys = []
+        self.shards = 0
+
+    def shard_name(self):
+        return f'{self.label}-{self.shard:06d}.tar'
+
+    def open(self):
+        self.shard += 1
+        self.keys = []
+        self.tar = tarfile.open(os.path.join(self.output, self.shard_name() + '.tmp'), 'w', format=tarfile.USTAR_FORMAT)
+
+    def close(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        self.tar = None
+        temp_file = os.path.join(self.output, self.shard_name() + '.tmp')
+        shard_file = os.path.join(self.output, self.shard_name())
+        os.replace(temp_file, shard_file)
+        self.shards += 1
+        # the offsets are read back from the member headers, so they are right whatever the header sizes
+        members = {}
+        with tarfile.open(shard_file) as tar:
+            for member in tar:
+                members[member.name] = (member.offset_data, member.size)
+        for key, ext in self.keys:
+            row = (key, self.label, self.shard_name(), ext) + members[key + ext] + members[key + '.json']
+            self.index.write('\t'.join(map(str, row)) + '\n')
+
+    def add_member(self, name, data, mtime):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime
+        info.mode = 0o444
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def write(self, key, ext, image, metadata, mtime):
+        sidecar = json.dumps(metadata, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        # a header and the data padded to whole blocks per member, the end of the archive is padded to a record
+        size = sum(tarfile.BLOCKSIZE * (1 + -(-len(data) // tarfile.BLOCKSIZE)) for data in (image, sidecar))
+        if self.tar is not None and self.keys and self.tar.offset + size + tarfile.RECORDSIZE > self.shard_size:
+            self.close()
+        if self.tar is None:
+            self.open()
+        self.add_member(key + ext, image, mtime)
+        self.add_member(key + '.json', sidecar, mtime)
+        self.keys.append((key, ext))
+
+
+def export_directory(args, pool, directory, index, include, exclude):
+    label = os.path.basename(os.path.normpath(directory))
+    manifest = read_manifest(directory)
+    images = []
+    for file_name in list_images(directory):
+        path = os.path.abspath(os.path.join(directory, file_name))
+        if (include is not None and path not in include) or (exclude is not None and path in exclude):
+            continue
+        images.append((file_name, path))
+    if not images:
+        print(f'No image to export in {directory}')
+        return 0, 0
+    file_names = {path: file_name for file_name, path in images}
+    paths = [path for _, path in images]
+    load = partial(load_image, resize=args.resize, quality=args.quality)
+    loaded = pool.imap(load, paths, chunksize=args.chunksize) if pool is not None else map(load, paths)
+
+    writer = ShardWriter(args.output, label, int(args.shard_size * 1024 * 1024), index)
+    count, unreadable = 0, 0
+    try:
+        for path, data, ext, size in loaded:
+            if data is None:
+                unreadable += 1
+                print(f'Could not read image {path}, skipping')
+                continue
+            file_name = file_names[path]
+            key = f'{count:08d}'
+            metadata = dict(manifest.get(os.path.normpath(file_name)) or parse_file_name(file_name))
+            metadata.update({'key': key, 'label': label, 'file': file_name.replace(os.sep, '/')})
+            if size is not None:
+                metadata['width'], metadata['height'] = size
+            writer.write(key, ext, data, metadata, int(os.path.getmtime(path)))
+            count += 1
+    finally:
+        writer.close()
+    print(f'{label}: {count} images exported to {writer.shards} shards, {unreadable} unreadable')
+    return count, writer.shards
+
+
+def read_member(shard_file, offset, size):
+    """Reads a member of a shard at the offset given by the index, without reading the rest of the shard"""
+    with open(shard_file, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def main():
+    args = get_args()
+    os.makedirs(args.output, exist_ok=True)
+    include = read_paths(args.include) if args.include else None
+    exclude = read_paths(args.exclude) if args.exclude else None
+    reencode = args.resize is not None or args.quality is not None
+    start = time.time()
+    count, shards = 0, 0
+    pool = Pool(args.workers) if reencode else None
+    try:
+        with open(os.path.join(args.output, INDEX_FILE), 'w') as index:
+            index.write('\t'.join(INDEX_COLUMNS) + '\n')
+            for directory in args.dirs:
+                dir_count, dir_shards = export_directory(args, pool, os.path.join(args.dirs_root, directory), index, include, exclude)
+                count += dir_count
+                shards += dir_shards
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+    print(f'{count} images exported to {shards} shards in {elapsed:.1f}s ({count / max(elapsed, 1e-6):.0f} images/s)')
+
+
+if __name__ == '__main__':
+    main()
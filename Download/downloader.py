@@ -0,0 +1,340 @@
+import hashlib
+import io
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from Download.metrics import Metrics
+
+# status codes worth retrying, everything else is returned (or raised) straight away
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# leading bytes of the image formats we keep, anything else is rejected before it reaches the disk
+IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",  # jpeg
+    b"\x89PNG\r\n\x1a\n",  # png
+    b"GIF87a",
+    b"GIF89a",
+    b"BM",  # bmp
+    b"II*\x00",  # tiff little endian
+    b"MM\x00*",  # tiff big endian
+)
+SIGNATURE_LENGTH = 12
+
+# result of a completed download, temp_file is renamed by the caller
+Download = namedtuple("Download", ["temp_file", "size", "sha256"])
+# sentinel telling a queue worker to exit
+STOP = object()
+
+
+class DownloadError(Exception):
+    """Raised when a response is rejected, e.g. not an image or larger than the size limit"""
+
+
+class RejectedImage(DownloadError):
+    """Raised when a downloaded image does not pass the quality filter, the url should not be fetched again"""
+
+
+class NearDuplicateImage(RejectedImage):
+    """Raised when a downloaded image is a near duplicate of an image already in the directory"""
+
+
+def is_image_header(head):
+    """Checks the magic bytes at the start of a file
+
+    Args:
+        head (bytes): first bytes of the file
+
+    Returns:
+        bool: True when the bytes start like one of the supported image formats
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return head.startswith(IMAGE_SIGNATURES)
+
+
+class ImageDownloader:
+    def __init__(self, user_agent, workers=8, connections_per_host=4, timeout=30, retries=3, backoff=0.5,
+                 max_bytes=20 * 1024 * 1024, chunk_size=64 * 1024, queue_size=100, metrics=None):
+        """Download engine shared by the scrapers.
+        A single requests.Session keeps the connections alive between requests, a bounded thread pool
+        fetches the urls in parallel and a semaphore per host caps the number of concurrent requests
+        sent to the same origin server. Responses are streamed in chunks to a temporary file, so the
+        memory used does not depend on the size of the remote files.
+
+        Args:
+            user_agent (str): User-Agent header sent with every request
+            workers (int): number of concurrent downloads, shared by all the scrapers using the downloader
+            connections_per_host (int): max number of concurrent requests to the same host
+            timeout (float): connect and read timeout in seconds
+            retries (int): number of retries on connection errors and retryable status codes
+            backoff (float): backoff factor between retries, sleeps backoff * 2 ** (retry - 1) seconds
+            max_bytes (int): transfers larger than this are aborted, None for no limit
+            chunk_size (int): size in bytes of the chunks read from the response
+            queue_size (int): max number of urls waiting for a download worker, producers block when the queue is full
+            metrics (Metrics): receives the download times, bytes, retries and errors, the metrics are discarded when None
+        """
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self.session = self.get_session(user_agent, retries, backoff)
+        self.host_slots = dict()
+        self.host_slots_lock = threading.Lock()
+        # scrapers running concurrently each have their own worker pool, this caps the total number of downloads
+        self.slots = threading.BoundedSemaphore(workers)
+
+    def get_session(self, user_agent, retries, backoff):
+        """Create a session with pooled connections and retry with exponential backoff.
+
+        Args:
+            user_agent (str): User-Agent header sent with every request
+            retries (int): number of retries
+            backoff (float): backoff factor between retries
+
+        Returns:
+            requests.Session: session shared by all the download workers
+        """
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                      status_forcelist=RETRY_STATUS_CODES)
+        # pool_maxsize is per host, there is never more than connections_per_host requests in flight for a host
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.connections_per_host, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({"User-Agent": user_agent})
+        return session
+
+    def host_slot(self, url):
+        """Returns the semaphore limiting the concurrent requests to the host of the given url
+
+        Args:
+            url (str): image url
+
+        Returns:
+            threading.BoundedSemaphore: semaphore of the url host
+        """
+        host = urlsplit(url).netloc
+        with self.host_slots_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.connections_per_host)
+            return self.host_slots[host]
+
+    def check_headers(self, response, validate):
+        """Rejects the response from its headers before any byte of the body is read
+
+        Args:
+            response (requests.Response): streamed response
+            validate (bool): check the Content-Type is an image
+        """
+        content_length = response.headers.get("Content-Length")
+        if self.max_bytes and content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            raise DownloadError(f"Content-Length {content_length} exceeds the limit of {self.max_bytes} bytes")
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        # some servers send images as octet-stream, the magic bytes decide in that case
+        if validate and content_type and not content_type.startswith("image/") and content_type != "application/octet-stream":
+            raise DownloadError(f"Content-Type {content_type} is not an image")
+
+    def fetch(self, url, directory, validate=True, quality_filter=None, labels=None):
+        """Downloads the url with transfer() and records the time taken, the retries and the class of the error if any
+
+        Args:
+            url (str): image url
+            directory (str): directory of the temporary file
+            validate (bool): reject the response when it is not an image
+            quality_filter (QualityFilter): checks applied to the image before it is written
+            labels (dict): labels of the metrics, e.g. the search engine and query the url was found with
+
+        Returns:
+            Download: path of the temporary file, size and sha256 hex digest of its content
+        """
+        labels = labels or {}
+        start = time.perf_counter()
+        try:
+            return self.transfer(url, directory, validate, quality_filter, labels)
+        except Exception as e:
+            self.metrics.inc("download_errors", error=type(e).__name__, **labels)
+            raise
+        finally:
+            self.metrics.observe("download", time.perf_counter() - start, **labels)
+
+    def transfer(self, url, directory, validate=True, quality_filter=None, labels=None):
+        """Sends a GET request with the url provided and streams the response to a temporary file in directory.
+        The caller renames the file to its final name, so a crash never leaves a truncated image behind.
+        With a quality filter the response is kept in memory, at most max_bytes, and only written once the image passed the filter.
+
+        Args:
+            url (str): image url
+            directory (str): directory of the temporary file, same as the final file so the rename is atomic
+            validate (bool): reject the response when it is not an image
+            quality_filter (QualityFilter): checks applied to the image before it is written
+            labels (dict): labels of the metrics
+
+        Returns:
+            Download: path of the temporary file, size and sha256 hex digest of its content
+        """
+        labels = labels or {}
+        with self.slots, self.host_slot(url):
+            with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                # retries made by urllib3 before this response, on connection errors and retryable status codes
+                retries = getattr(response.raw, "retries", None)
+                if retries is not None and retries.history:
+                    self.metrics.inc("download_retries", len(retries.history), **labels)
+                response.raise_for_status()
+                self.check_headers(response, validate)
+                if quality_filter is None:
+                    download = self.write_temp_file(directory, lambda f: self.stream_to_file(response, f, validate))
+                    self.metrics.inc("download_bytes", download.size, **labels)
+                    return download
+                body = io.BytesIO()
+                size, sha256 = self.stream_to_file(response, body, validate)
+                self.metrics.inc("download_bytes", size, **labels)
+        # decoding is CPU work, the connection slots are released before
+        reason = quality_filter.check(body.getbuffer(), url)
+        if reason is not None:
+            raise RejectedImage(f"Image rejected: {reason}")
+
+        def write_body(f):
+            f.write(body.getbuffer())
+            return size, sha256
+        try:
+            return self.write_temp_file(directory, write_body)
+        except BaseException:
+            # the filter may hold state for the image, e.g. its claimed near duplicate hash, that no saved file will own
+            quality_filter.release(sha256)
+            raise
+
+    def write_temp_file(self, directory, write):
+        """Creates a temporary file in directory, it is removed when writing fails
+
+        Args:
+            directory (str): directory of the temporary file
+            write (callable): called with the opened file, returns (size, sha256) of the written content
+
+        Returns:
+            Download: path of the temporary file, size and sha256 hex digest of its content
+        """
+        fd, temp_file = tempfile.mkstemp(prefix=".", suffix=".part", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                size, sha256 = write(f)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+        return Download(temp_file, size, sha256)
+
+    def stream_to_file(self, response, f, validate):
+        """Writes the response body in chunks, aborting early on non images and oversized transfers
+
+        Args:
+            response (requests.Response): streamed response
+            f (file): opened temporary file or in memory buffer
+            validate (bool): check the magic bytes of the body
+
+        Returns:
+            tuple: (size, sha256) number of bytes written and hex digest of the body
+        """
+        head = b""
+        size = 0
+        digest = hashlib.sha256()
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
+            size += len(chunk)
+            if self.max_bytes and size > self.max_bytes:
+                raise DownloadError(f"Transfer aborted, image larger than {self.max_bytes} bytes")
+            if validate and len(head) < SIGNATURE_LENGTH:
+                head += chunk[:SIGNATURE_LENGTH]
+                if len(head) >= SIGNATURE_LENGTH and not is_image_header(head):
+                    raise DownloadError("Response body is not an image")
+            f.write(chunk)
+            digest.update(chunk)
+        if size == 0:
+            raise DownloadError("Empty response body")
+        if validate and len(head) < SIGNATURE_LENGTH and not is_image_header(head):
+            raise DownloadError("Response body is not an image")
+        return size, digest.hexdigest()
+
+    def queue(self, directory, on_result, quality_filter=None, labels=None):
+        """Starts download workers consuming urls as they are produced
+
+        Args:
+            directory (str): directory of the temporary files
+            on_result (callable): called from the worker threads with (url, download, error)
+            quality_filter (QualityFilter): checks applied to the images before they are written
+            labels (dict): labels of the metrics of the downloads
+
+        Returns:
+            DownloadQueue: started queue, urls are added with put() and the workers stopped with close()
+        """
+        download_queue = DownloadQueue(self, directory, on_result, quality_filter, labels)
+        download_queue.start()
+        return download_queue
+
+    def close(self):
+        self.session.close()
+        logging.debug("download session closed")
+
+
+class DownloadQueue:
+    def __init__(self, downloader, directory, on_result, quality_filter=None, labels=None):
+        """Bounded queue of urls consumed by download worker threads.
+        The producer, a scraper harvesting urls, blocks on put() when the workers fall behind.
+
+        Args:
+            downloader (ImageDownloader): download engine
+            directory (str): directory of the temporary files
+            on_result (callable): called from the worker threads with (url, download, error), download is None when the download failed
+            quality_filter (QualityFilter): checks applied to the images before they are written
+            labels (dict): labels of the metrics of the downloads
+        """
+        self.downloader = downloader
+        self.directory = directory
+        self.on_result = on_result
+        self.quality_filter = quality_filter
+        self.labels = labels
+        self.urls = queue.Queue(maxsize=downloader.queue_size)
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(downloader.workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, url):
+        """Queues the url, blocks while the queue is full
+
+        Args:
+            url (str): image url
+        """
+        self.urls.put(url)
+
+    def work(self):
+        while True:
+            url = self.urls.get()
+            if url is STOP:
+                break
+            download, error = None, None
+            try:
+                download = self.downloader.fetch(url, self.directory, quality_filter=self.quality_filter, labels=self.labels)
+            except Exception as e:
+                error = e
+            try:
+                self.on_result(url, download, error)
+            except Exception as e:  # a worker must never die, the producer would block on the full queue
+                logging.error(f"Failed to handle the download of {url}: {e}")
+
+    def close(self):
+        """Waits for the queued urls to be downloaded and stops the workers"""
+        for _ in self.threads:
+            self.urls.put(STOP)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,161 @@
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.firefox.options import Options
+
+
+class WebDriverPool:
+    def __init__(self, user_agent, size=1, headless=False, max_jobs=50):
+        """Pool of warm firefox webdrivers borrowed by the scrapers.
+        Drivers are started lazily, reset between jobs, replaced when they crash and
+        recycled after max_jobs jobs to bound the memory used by long running browsers.
+
+        Args:
+            user_agent (str): User-Agent of the browsers
+            size (int): max number of browsers running at the same time
+            headless (bool): When the flag is True scripts runs without invoking the browser
+            max_jobs (int): number of jobs after which a driver is restarted, None to never restart
+        """
+        self.user_agent = user_agent
+        self.size = size
+        self.headless = headless
+        self.max_jobs = max_jobs
+        self.idle = queue.LifoQueue()  # last released driver first, it has the warmest cache
+        self.slots = threading.BoundedSemaphore(size)
+        self.jobs = dict()
+        self.lock = threading.Lock()
+
+    def create_driver(self):
+        """Instantiate firefox webdriver.
+        useful link to change User-Agent if required: https://developers.whatismybrowser.com/
+        # TODO plan to use this https://github.com/SergeyPirogov/webdriver_manager
+
+        Returns:
+        Webdriver : A webdriver object used crawl webpages.
+        """
+        browser_options = Options()
+        if self.headless:
+            browser_options.add_argument("--headless")
+
+        profile = webdriver.FirefoxProfile()
+        profile.accept_untrusted_certs = True
+        profile.set_preference("general.useragent.override", self.user_agent)
+
+        # create webdriver Firefox instance
+        driver = webdriver.Firefox(options=browser_options, firefox_profile=profile)
+        with self.lock:
+            self.jobs[driver] = 0
+        logging.info("started a new firefox webdriver")
+        return driver
+
+    def is_alive(self, driver):
+        """Checks the browser still answers
+
+        Args:
+            driver (Webdriver): webdriver to check
+
+        Returns:
+            bool: False when the browser crashed or was closed
+        """
+        try:
+            driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    def reset(self, driver):
+        """Clears the state left by the previous job: cookies, storage, extra windows and frames
+
+        Args:
+            driver (Webdriver): webdriver to reset
+        """
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        driver.switch_to.default_content()
+        driver.delete_all_cookies()
+        try:
+            driver.execute_script("window.localStorage.clear(); window.sessionStorage.clear();")
+        except WebDriverException:
+            pass  # storage is not available on some pages, e.g. about:blank
+        driver.get("about:blank")
+
+    def discard(self, driver):
+        """Quits the driver, it is not given back to the pool
+
+        Args:
+            driver (Webdriver): webdriver to quit
+        """
+        with self.lock:
+            self.jobs.pop(driver, None)
+        try:
+            driver.quit()
+        except WebDriverException as e:
+            logging.error(f"Error while closing the webdriver {e}")
+
+    def acquire(self):
+        """Borrows a driver, blocks while size drivers are in use.
+
+        Returns:
+            Webdriver: a healthy webdriver
+        """
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    driver = self.idle.get_nowait()
+                except queue.Empty:
+                    return self.create_driver()
+                if self.is_alive(driver):
+                    return driver
+                logging.warning("discarding a crashed webdriver")
+                self.discard(driver)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, driver):
+        """Gives the driver back to the pool, crashed and worn out drivers are quit and replaced on the next acquire
+
+        Args:
+            driver (Webdriver): borrowed webdriver
+        """
+        try:
+            with self.lock:
+                self.jobs[driver] = self.jobs.get(driver, 0) + 1
+                worn_out = self.max_jobs is not None and self.jobs[driver] >= self.max_jobs
+            if worn_out or not self.is_alive(driver):
+                self.discard(driver)
+                return
+            try:
+                self.reset(driver)
+                self.idle.put(driver)
+            except WebDriverException as e:
+                logging.error(f"Failed to reset the webdriver {e}")
+                self.discard(driver)
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def driver(self):
+        """Context manager borrowing a driver for the duration of a job"""
+        driver = self.acquire()
+        try:
+            yield driver
+        finally:
+            self.release(driver)
+
+    def close(self):
+        """Quits all the idle drivers"""
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(driver)
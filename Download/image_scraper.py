@@ -1,20 +1,71 @@
-import glob
 import os
+import json
+import contextlib
 import logging
+import threading
 import time
-import requests
-from random import randint
+from collections import defaultdict, deque
+from urllib.parse import quote_plus, urljoin, urlsplit
 
+import requests
+from bs4 import BeautifulSoup
 from tqdm import tqdm
-from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.support import expected_conditions
-from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, TimeoutException, WebDriverException
+
+from Download.downloader import ImageDownloader, NearDuplicateImage, RejectedImage
+from Download.driver_pool import WebDriverPool
+from Download.manifest import Manifest
+from Download.metrics import Metrics
+from Download.url_index import UrlIndex, normalize_url
+from Download.waits import Throttle, content_grew, preview_ready
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
 
+# serializes the writes of concurrent scrapers saving to the same directory
+DIRECTORY_LOCKS = defaultdict(threading.Lock)
+# perceptual hashes of the images of each directory, shared by the scrapers saving to the directory
+HASH_INDEXES = dict()
+
+EXTRACTION_MODES = ("auto", "bulk", "click")
+HARVEST_MODES = ("auto", "http", "browser")
+
+# full resolution urls of all the results of the page, in a single webdriver call instead of a click per result.
+# Bing keeps the metadata of each result, murl being the image url, as json in the m attribute of its link
+BING_EXTRACT_SCRIPT = """
+return Array.from(document.querySelectorAll("a.iusc")).map(function (link) {
+    try { return JSON.parse(link.getAttribute("m")).murl; } catch (e) { return null; }
+});
+"""
+# Google embeds ["url", height, width] arrays in the inline scripts, the thumbnails are served by gstatic
+GOOGLE_EXTRACT_SCRIPT = """
+var urls = [];
+var seen = {};
+var pattern = /\\["(https?:\\/\\/[^"]+)",(\\d+),(\\d+)\\]/g;
+Array.from(document.scripts).forEach(function (script) {
+    var match;
+    while ((match = pattern.exec(script.textContent)) !== null) {
+        var url;
+        try { url = JSON.parse('"' + match[1] + '"'); } catch (e) { continue; }
+        if (url.indexOf("gstatic.com") === -1 && !seen[url]) {
+            seen[url] = true;
+            urls.push(url);
+        }
+    }
+});
+return urls;
+"""
+# same url as the per element harvest: the src of the first image of each result, up to the first &
+YAHOO_EXTRACT_SCRIPT = """
+return Array.from(document.querySelectorAll("li[id*=resitem-]")).map(function (item) {
+    var image = item.querySelector("a img");
+    var src = image ? image.getAttribute("src") || image.getAttribute("data-src") : null;
+    return src ? new URL(src, document.baseURI).href.split("&")[0] : null;
+});
+"""
+
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4422.0 Safari/537.36"
 
 
@@ -32,8 +83,18 @@ def open_file(file):
         return f.read().splitlines()
 
 
+class HarvestError(Exception):
+    """Raised when the results page fetched over http could not be parsed, the browser harvest is used instead"""
+
+
 class ImageScraper:
-    def __init__(self, query, save_img_dir, index, num_of_images, run_headless):
+    # results page fetched by the http harvest, None for the engines that need a browser
+    http_url = None
+
+    def __init__(self, query, save_img_dir, index, num_of_images, run_headless, downloader=None, url_index=None, shard_size=None,
+                 driver_pool=None, quality_filter=None, near_duplicate_distance=None, min_yield=0, yield_window=50,
+                 engine_url=None, metrics=None, wait_timeout=5, throttle=None, extraction="auto", harvest="browser",
+                 journal=None, object_store=None):
         """Initialize the variables
 
         Args:
@@ -41,129 +102,341 @@ class ImageScraper:
             save_img_dir (str): directory name where the images are saved
             index (str): used in formatting the file name
             run_headless (bool): run the script without launching the firefox browser
+            downloader (ImageDownloader): download engine shared between scrapers, a new one is created when None
+            url_index (UrlIndex): index of the urls already downloaded, the default index file is used when None
+            shard_size (int): number of images per sub directory of save_img_dir, None to save all the images in save_img_dir
+            driver_pool (WebDriverPool): pool the webdriver is borrowed from, a single driver pool is created when None
+            quality_filter (QualityFilter): checks applied to the downloaded images before they are saved, None to save all images
+            near_duplicate_distance (int): reject the images whose dHash is within this Hamming distance of an image of the directory, None to disable
+            min_yield (float): stop the harvest when the share of new urls among the last yield_window urls falls below this, 0 to harvest all the urls
+            yield_window (int): number of last harvested urls the yield is measured on
+            engine_url (str): scheme and host replacing the ones of the search engine url, e.g. a local fake engine for benchmarks
+            metrics (Metrics): receives the timings and counts of the scrape, labelled by engine and query, discarded when None
+            wait_timeout (float): max seconds waited for the page to load more thumbnails or for a preview to show its image
+            throttle (Throttle): pauses between the browser actions, no pause when None
+            extraction (str): "bulk" reads the urls of all the results in one script call, "click" opens each result,
+                "auto" clicks only when the script found no url
+            harvest (str): "http" pages through the results with plain http requests, "browser" uses firefox,
+                "auto" uses firefox only for the engines without http harvest or when the http results could not be parsed
+            journal (JobJournal): records the harvested urls until they are downloaded and the end of the harvest, None to not journal
+            object_store (ObjectStore): stores each content once, the saved files are hard links to its objects, None to save plain files
         """
+        assert extraction in EXTRACTION_MODES, f"extraction must be one of {EXTRACTION_MODES}"
+        assert harvest in HARVEST_MODES, f"harvest must be one of {HARVEST_MODES}"
         self.query = query
+        if engine_url:
+            self.url = engine_url.rstrip("/") + urlsplit(self.url).path
+            if self.http_url is not None:
+                self.http_url = engine_url.rstrip("/") + urlsplit(self.http_url).path
         self.save_img_dir = save_img_dir.replace(" ", "_")  # replace space with _
         str_replace = query.replace(" ", "_")
         self.num_of_images = num_of_images
         self.file_format = f"{index}_{self.search_engine}_{str_replace}"
-        self.driver = self.get_webdriver(run_headless)
         self.images = list()
-        self.wait = WebDriverWait(self.driver, timeout=5)
+        self.seen_urls = set()
+        self.duplicate_count = 0
+        self.known_count = 0
+        self.min_yield = min_yield
+        # True for each new url, False for each url already downloaded or already harvested
+        self.recent_urls = deque(maxlen=yield_window)
+        self.stopped_early = False
+        self.download_queue = None
+        # the webdriver is only borrowed from the pool for the duration of scrape()
+        self.owns_driver_pool = driver_pool is None
+        self.driver_pool = driver_pool if driver_pool is not None else WebDriverPool(USER_AGENT, headless=run_headless)
+        self.driver = None
+        self.wait = None
         os.makedirs(self.save_img_dir, exist_ok=True)  # create save_img_dir
         self.links_file = os.path.join(self.save_img_dir, "links.txt")
         if not os.path.isfile(self.links_file):  # create empty file if links.txt file not found within directory
-            open(self.links_file, "w").close()
-            self.list_of_links = list()
-        else:
-            self.list_of_links = open_file(self.links_file)
+            open(self.links_file, "a").close()  # append mode, another scraper might be writing to it already
+        self.url_index = url_index if url_index is not None else UrlIndex()
+        # links added to links.txt outside of the index (older runs, manual edits) are picked up here
+        self.url_index.import_links_file(self.links_file, self.save_img_dir)
+        self.shard_size = shard_size
+        self.quality_filter = quality_filter
+        self.near_duplicate_distance = near_duplicate_distance
+        self.hash_index = None
         self.counter = 0
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.labels = {"engine": self.search_engine, "query": query}
+        self.downloader = downloader if downloader is not None else ImageDownloader(user_agent=USER_AGENT, metrics=self.metrics)
+        self.wait_timeout = wait_timeout
+        self.throttle = throttle if throttle is not None else Throttle()
+        self.extraction = extraction
+        self.harvest_mode = harvest
+        self.journal = journal
+        self.object_store = object_store
+
+    def pause(self, reason):
+        """Sleeps as long as the throttle policy asks and records the time slept
 
-    def get_webdriver(self, headless):
-        """Instantiate firefox webdriver.
-        useful link to change User-Agent if required: https://developers.whatismybrowser.com/
-        # TODO plan to use this https://github.com/SergeyPirogov/webdriver_manager
+        Args:
+            reason (str): label of the pause, e.g. "scroll"
+        """
+        seconds = self.throttle.delay()
+        if seconds > 0:
+            time.sleep(seconds)
+            self.metrics.observe("sleep", seconds, reason=reason, **self.labels)
+
+    def wait_for(self, condition, reason, timeout=None):
+        """Waits until the condition returns a true value, at most wait_timeout seconds, and records the time waited
 
         Args:
-            headless (bool): When the flag is True scripts runs without invoking the browser
+            condition (callable): called with the driver, e.g. a condition of Download.waits
+            reason (str): label of the wait, e.g. "scroll"
+            timeout (float): max seconds to wait, wait_timeout when None
 
         Returns:
-        Webdriver : A webdriver object used crawl webpages.
+            the value returned by the condition, None on timeout
         """
-        browser_options = Options()
-        if headless:
-            browser_options.add_argument("--headless")
-
-        profile = webdriver.FirefoxProfile()
-        profile.accept_untrusted_certs = True
-        profile.set_preference("general.useragent.override", USER_AGENT)
-
-        # create webdriver Firefox instance
-        driver = webdriver.Firefox(options=browser_options, firefox_profile=profile)
-        return driver
+        start = time.perf_counter()
+        try:
+            return WebDriverWait(self.driver, self.wait_timeout if timeout is None else timeout, poll_frequency=0.1).until(condition)
+        except TimeoutException:
+            self.metrics.inc("wait_timeouts", reason=reason, **self.labels)
+            return None
+        finally:
+            self.metrics.observe("wait", time.perf_counter() - start, reason=reason, **self.labels)
 
     def scroll_down(self):
         # code from https://stackoverflow.com/questions/48850974/selenium-scroll-to-end-of-page-in-dynamically-loading-webpage
         """A method for scrolling the page."""
 
-        # Get scroll height.
+        start = time.perf_counter()
+        # Get scroll height and number of thumbnails.
         last_height = self.driver.execute_script("return document.body.scrollHeight")
+        last_count = len(self.driver.find_elements_by_css_selector(self.image_thumbnail_tag))
 
         while True:
             # Scroll down to the bottom.
             self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
             # self.driver.find_element_by_css_selector("body").send_keys(Keys.PAGE_DOWN)
 
-            # Wait for the page to load.
-            time.sleep(randint(2, 7))
-
-            # Calculate new scroll height and compare with last scroll height.
-            new_height = self.driver.execute_script("return document.body.scrollHeight")
-
-            if new_height == last_height:
+            # Wait for the page to load more thumbnails, the end of the results is reached when nothing changes before the timeout.
+            grown = self.wait_for(content_grew(last_height, self.image_thumbnail_tag, last_count), "scroll")
+            if grown is None:
                 break
-            last_height = new_height
+            last_height, last_count = grown
+            if last_count >= self.num_of_images:
+                break  # the results past num_of_images are never harvested
+            self.pause("scroll")
 
         # Scroll one last time
         self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+        self.metrics.observe("scroll", time.perf_counter() - start, **self.labels)
 
-    def get_image(self, url, image_file):
+    def get_image(self, url, image_file, validate=True):
         """Sends a GET request with the image URL provided and saves the image.
+        The response is streamed to a temporary file which is renamed to image_file once complete.
 
         Args:
             url (str): image url
             image_file (str): image file name
+            validate (bool): reject responses that are not images
         """
-        img_request = requests.request("GET", url, headers={"User-Agent": USER_AGENT})
-        with open(image_file, "wb") as f:
-            f.write(img_request.content)
+        download = self.downloader.fetch(url, os.path.dirname(image_file) or ".", validate=validate, labels=self.labels)
+        os.replace(download.temp_file, image_file)
 
-    def download_images(self):
-        """Retrives images from the image url list and downloads one by one.
+    def is_new_url(self, img_src):
+        """Checks that the scraped src is an http url not already downloaded to the directory
+
+        Args:
+            img_src (str): src attribute of the image
 
         Returns:
-            int: Total number of images downloaded
+            bool: True when the image has to be downloaded
         """
-        logging.info("checking for duplicate urls...")
-        logging.info(f"Total duplicate URLs {len(self.images) - len(set(self.images))}")
-        self.images = set(self.images)  # remove the duplicates
-        if self.images:  # if list has links, download the images
-            index = self.get_file_index()  # get the corresponding index
-            failure_count = 0
-            success_count = 0
-            write_links_file = open(self.links_file, 'a')
-            for image_url in tqdm(self.images, desc="Downloading images", ascii=True, ncols=100):
-                file_name = os.path.join(self.save_img_dir, f"{self.file_format}_{str(index).zfill(5)}.jpg")
-                try:
-                    self.get_image(image_url, file_name)
-                    success_count += 1
-                    index += 1
-                    write_links_file.writelines(f"\n{image_url}")  # append the image url in the links.txt file
-                except Exception as e:
-                    logging.error(f"{e}, image URL: {image_url}")
-                    failure_count += 1
-            write_links_file.close()
-            logging.info(f"Failed to retrieve {failure_count} images")
-            logging.info(f"Total number of images downloaded: {success_count}")
+        if img_src is None or "http" not in img_src:
+            return False
+        if self.url_index.contains(img_src, self.save_img_dir):
+            self.known_count += 1
+            self.recent_urls.append(False)
+            return False
+        return True
+
+    def low_yield(self):
+        """Checks the share of new urls among the last harvested urls, called by the harvest loops to stop early
+
+        Returns:
+            bool: True when the harvest should stop
+        """
+        if not self.min_yield or len(self.recent_urls) < self.recent_urls.maxlen:
+            return False
+        if sum(self.recent_urls) / len(self.recent_urls) >= self.min_yield:
+            return False
+        logging.info(f"{self.search_engine}: less than {self.min_yield:.0%} new urls among the last {len(self.recent_urls)}, stopping")
+        self.stopped_early = True
+        return True
+
+    def add_image(self, img_src):
+        """Records a harvested image url and queues it for download when the download workers are running
+
+        Args:
+            img_src (str): image url
+        """
+        # urls differing only by scheme or tracking parameters are the same image
+        key = normalize_url(img_src)
+        if key in self.seen_urls:
+            self.duplicate_count += 1
+            self.recent_urls.append(False)
+            return
+        self.seen_urls.add(key)
+        self.recent_urls.append(True)
+        self.images.append(img_src)
+        if self.journal is not None:
+            self.journal.add_url(img_src)
+        if self.download_queue is not None:
+            self.download_queue.put(img_src)  # blocks when the download workers fall behind
+
+    def start_downloads(self):
+        """Starts the download workers, urls passed to add_image are downloaded while the harvest goes on"""
+        self.stats = {"found": 0, "downloaded": 0, "rejected": 0, "near_duplicates": 0, "failed": 0, "linked": 0}
+        self.stats_lock = threading.Lock()
+        self.manifest = Manifest(self.save_img_dir, shard_size=self.shard_size)
+        image_filter = self.quality_filter
+        if self.near_duplicate_distance is not None:
+            from Download.near_duplicates import HashIndex, NearDuplicateFilter  # requires opencv and numpy
+            directory = os.path.abspath(self.save_img_dir)
+            with DIRECTORY_LOCKS[directory]:
+                if directory not in HASH_INDEXES:
+                    HASH_INDEXES[directory] = HashIndex(self.manifest)
+                self.hash_index = HASH_INDEXES[directory]
+            image_filter = NearDuplicateFilter(self.hash_index, self.near_duplicate_distance, self.quality_filter)
+        self.links_file_handle = open(self.links_file, 'a')
+        self.progress = tqdm(desc="Downloading images", ascii=True, ncols=100)
+        self.download_queue = self.downloader.queue(self.save_img_dir, self.handle_download, image_filter, labels=self.labels)
+
+    def handle_download(self, image_url, download, error):
+        """Saves a completed download, called from the download workers
+
+        Args:
+            image_url (str): image url
+            download (Download): completed download, None when the download failed
+            error (Exception): download error
+        """
+        outcome = "failed"
+        if isinstance(error, RejectedImage):
+            logging.info(f"{error}, image URL: {image_url}")
+            outcome = "near_duplicates" if isinstance(error, NearDuplicateImage) else "rejected"
+            # recorded so the url is not fetched again, rejected urls are not written to links.txt
+            self.url_index.add(image_url, self.save_img_dir, status="near_duplicate" if outcome == "near_duplicates" else "rejected")
+        elif error is not None:
+            logging.error(f"{error}, image URL: {image_url}")
         else:
+            try:
+                _, is_new = self.save_image(self.manifest, image_url, download)
+                if not is_new:
+                    with self.stats_lock:
+                        self.stats["linked"] += 1
+                with DIRECTORY_LOCKS[os.path.abspath(self.save_img_dir)]:
+                    self.links_file_handle.writelines(f"\n{image_url}")  # append the image url in the links.txt file
+                    self.links_file_handle.flush()
+                self.url_index.add(image_url, self.save_img_dir)
+                outcome = "downloaded"
+            except Exception as e:
+                logging.error(f"{e}, image URL: {image_url}")
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(download.temp_file)
+                if self.hash_index is not None:
+                    self.hash_index.release(download.sha256)
+        with self.stats_lock:
+            self.stats[outcome] += 1
+            self.progress.update()
+        if self.journal is not None:
+            self.journal.url_done(image_url)
+
+    def finish_downloads(self):
+        """Waits for the queued downloads and closes the files
+
+        Returns:
+            dict: number of urls found, images downloaded, images rejected and failed downloads
+        """
+        # time left waiting for the downloads once the harvest is over
+        with self.metrics.timer("download_drain", **self.labels):
+            self.download_queue.close()
+        self.download_queue = None
+        self.progress.close()
+        self.links_file_handle.close()
+        self.manifest.close()
+        self.url_index.flush()
+        # links.txt now holds the new urls, skip them on the next import
+        self.url_index.import_links_file(self.links_file, self.save_img_dir)
+        self.stats["found"] = len(self.images)
+        self.stats["known"] = self.known_count
+        self.stats["stopped_early"] = int(self.stopped_early)
+        for outcome in ("downloaded", "rejected", "near_duplicates", "failed"):
+            self.metrics.inc("images", self.stats[outcome], outcome=outcome, **self.labels)
+        for status, count in (("new", len(self.images)), ("known", self.known_count), ("duplicate", self.duplicate_count)):
+            self.metrics.inc("urls", count, status=status, **self.labels)
+        logging.info(f"Total duplicate URLs {self.duplicate_count}")
+        if not self.images:
             logging.info(f"No new images found!!")
+        logging.info(f"Failed to retrieve {self.stats['failed']} images")
+        if self.quality_filter is not None:
+            logging.info(f"Images rejected by the quality filter: {self.stats['rejected']}")
+        if self.near_duplicate_distance is not None:
+            logging.info(f"Near duplicate images rejected: {self.stats['near_duplicates']}")
+        if self.object_store is not None:
+            logging.info(f"Images already in the object store, saved as links: {self.stats['linked']}")
+        logging.info(f"Total number of images downloaded: {self.stats['downloaded']}")
+        return self.stats
 
-    def get_file_index(self):
-        """function checks whether files are present for the given search engine and query
-        if files are found, gets the max number from file name else return index 1
+    def download_images(self):
+        """Retrives images from the image url list and downloads them concurrently with the download engine.
+        scrape() downloads the images while they are harvested, this is for urls collected beforehand.
 
         Returns:
-            int: max number from the file name or 1
+            dict: number of urls found, images downloaded, images rejected and failed downloads
         """
-        file_path = os.path.join(self.save_img_dir, self.file_format) + "*"
-        list_of_files = glob.glob(file_path)
-        if not list_of_files:  # Empty list returns False
-            return 1  # index set to 1
-        else:
-            list_of_files.sort()  # sort by ascending order
-            last_file = list_of_files[-1]  # get the last file
-            index = last_file.split("_")[-1].split(".")[0]  # gives 99 from 0_yahoo_some_query_99.jpg
-            return int(index)
+        images, self.images = self.images, list()
+        self.start_downloads()
+        try:
+            for image_url in images:
+                if self.is_new_url(image_url):
+                    self.add_image(image_url)
+        finally:
+            stats = self.finish_downloads()
+        return stats
+
+    def save_image(self, manifest, image_url, download):
+        """Moves a completed download to its final file name and records it in the manifest.
+        The index is handed out by the manifest once the download succeeded, so the indices have no gaps.
+        When the image can not be saved, the file is removed before the error is raised, so no file is left without its record.
+
+        Args:
+            manifest (Manifest): manifest of save_img_dir
+            image_url (str): image url
+            download (Download): completed download
+
+        Returns:
+            tuple: (path of the saved image, False when its content was already in the object store)
+        """
+        index, sequence = manifest.reserve(self.file_format)
+        file_name = manifest.file_path(f"{self.file_format}_{str(index).zfill(5)}.jpg", sequence)
+        file_path = os.path.join(self.save_img_dir, file_name)
+        try:
+            if self.shard_size:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            # atomic, the file is either complete or absent
+            object_path, is_new = None, True
+            if self.object_store is not None:
+                is_new = self.object_store.store(download.temp_file, download.sha256, file_path)
+                object_path = self.object_store.object_path(download.sha256)
+                self.metrics.inc("objects", status="new" if is_new else "linked", **self.labels)
+            else:
+                os.replace(download.temp_file, file_path)
+            dhash = self.hash_index.assign(download.sha256, file_name) if self.hash_index is not None else None
+            manifest.add(file_name, self.file_format, index, image_url, self.search_engine, self.query, download.size, download.sha256, dhash,
+                         object_path)
+        except BaseException:
+            # the name was reserved for this image, anything at file_path was written here. An object left without link is
+            # removed by the garbage collection of the store
+            for path in (download.temp_file, file_path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            raise
+        return file_path, is_new
 
     def get_url(self):
         """format the url and navigate to it.
@@ -173,7 +446,8 @@ class ImageScraper:
             url = url + "&tbm=isch"  # this is required to display image search results page for google.
         logging.info(url)
         logging.info(f"Total number of images to be scraped: {self.num_of_images}")
-        self.driver.get(url)
+        with self.metrics.timer("page_load", **self.labels):
+            self.driver.get(url)
 
     def click_button(self, locator):
         """function tries to find the locator passed and clicks on it
@@ -185,13 +459,16 @@ class ImageScraper:
             button = self.driver.find_element_by_css_selector(locator)
             if button.is_displayed():
                 button.click()
-                time.sleep(1)
+                self.metrics.inc("button_clicks", **self.labels)
+                # the next scroll_down waits for the thumbnails loaded by the click
+                self.pause("click")
         except NoSuchElementException:
             logging.error(f"Element with locator {locator} not found!")
 
     def load_all_images(self):
         """scrolls down to load the dynamic webpage and clicks on the load more image button when found
         """
+        start = time.perf_counter()
         self.scroll_down()
         try:
             # button_tag = self.driver.find_element_by_css_selector(self.see_more_image_button_tag)
@@ -205,6 +482,7 @@ class ImageScraper:
                     break
         except NoSuchElementException:
             logging.info(f"Page does not contain load images button")
+        self.metrics.observe("load_all_images", time.perf_counter() - start, **self.labels)
 
     def get_all_elements_from_image_thumbnail(self):
         """Gets all the webdriver elements from the image thumbnails in the search results page.
@@ -219,6 +497,161 @@ class ImageScraper:
         return list_of_elements
 
     def scrape(self):
+        """Harvests the image urls over http or with a webdriver borrowed from the pool.
+        The images are downloaded by the download workers while the harvest goes on,
+        the driver goes back to the pool before waiting for the last downloads.
+
+        Returns:
+            dict: number of urls found, urls already downloaded, images downloaded, images rejected and failed downloads
+        """
+        self.start_downloads()
+        try:
+            if not self.harvest_over_http():
+                self.harvest_with_browser()
+            if self.journal is not None:
+                self.journal.harvested()
+        finally:
+            if self.owns_driver_pool:
+                self.driver_pool.close()
+            stats = self.finish_downloads()
+        return stats
+
+    def harvest_with_browser(self):
+        """Borrows a webdriver from the pool for the duration of the harvest"""
+        wait_start = time.perf_counter()
+        with self.driver_pool.driver() as driver:
+            self.metrics.observe("driver_wait", time.perf_counter() - wait_start, **self.labels)
+            self.driver = driver
+            self.wait = WebDriverWait(self.driver, timeout=self.wait_timeout)
+            try:
+                with self.metrics.timer("harvest", **self.labels):
+                    self.harvest()
+            finally:
+                self.driver = None
+                self.wait = None
+
+    def harvest_over_http(self):
+        """Harvests the image urls with plain http requests when the harvest mode and the engine allow it
+
+        Returns:
+            bool: False when the urls are still to be harvested with the browser
+        """
+        if self.harvest_mode == "browser":
+            return False
+        if self.http_url is None:
+            if self.harvest_mode == "auto":
+                return False
+            # the job fails, so it is not recorded as done and a resumed run with a browser does it
+            raise HarvestError(f"{self.search_engine} results can not be harvested over http")
+        try:
+            with self.metrics.timer("harvest_http", **self.labels):
+                self.harvest_http()
+        except HarvestError as e:
+            self.metrics.inc("http_fallbacks", **self.labels)
+            if self.harvest_mode == "http":
+                raise
+            logging.warning(f"{self.search_engine}: http harvest failed, using the browser: {e}")
+            return False
+        logging.info(f"Total number of new images found: {len(self.images)}")
+        return True
+
+    def harvest_http(self):
+        """Pages through the results with the session of the downloader, up to num_of_images results.
+        Raises HarvestError when the first page can not be fetched or parsed, later pages only end the harvest.
+        """
+        offset = 0
+        harvested = set()
+        while self.counter < self.num_of_images:
+            page_url = self.http_page_url(offset)
+            try:
+                with self.metrics.timer("page_load_http", **self.labels):
+                    response = self.downloader.session.get(page_url, timeout=self.downloader.timeout)
+                    response.raise_for_status()
+                urls = self.parse_results(response.text, response.url)
+            except (requests.RequestException, HarvestError) as e:
+                if offset == 0:
+                    raise HarvestError(f"{page_url}: {e}")
+                logging.error(f"{self.search_engine}: failed to fetch the results page {page_url} {e}")
+                break
+            if offset == 0 and not urls:
+                raise HarvestError(f"{page_url}: no result found in the page")
+            page = [url for url in urls if url not in harvested]
+            if not page:  # past the last results the engines repeat the last page or return an empty one
+                break
+            harvested.update(page)
+            for url in page[:self.num_of_images - self.counter]:
+                if self.low_yield():
+                    return
+                self.metrics.inc("thumbnails", **self.labels)
+                if self.is_new_url(url):
+                    self.add_image(url)
+                self.counter += 1
+            offset += len(urls)
+            self.pause("page")
+
+    def http_page_url(self, offset):
+        """Url of the results page starting at the given result, for the engines with http harvest
+
+        Args:
+            offset (int): number of results before the page
+        """
+        raise NotImplementedError("Override this method!!")
+
+    def parse_results(self, page_source, page_url):
+        """Full resolution urls of the results of an html page, raises HarvestError when the page is not a results page
+
+        Args:
+            page_source (str): html of the page
+            page_url (str): url of the page, relative urls are resolved against it
+        """
+        raise NotImplementedError("Override this method!!")
+
+    def harvest(self):
+        """Opens the results page and harvests the urls with a single script call, or by clicking the results
+        """
+        self.open_results()
+        if self.extraction != "click":
+            urls = self.extract_urls()
+            if urls or self.extraction == "bulk":
+                self.add_urls(urls)
+                logging.info(f"Total number of new images found: {len(self.images)}")
+                return
+            logging.info(f"{self.search_engine}: no url found in the page, clicking the results")
+        self.harvest_clicks()
+        logging.info(f"Total number of new images found: {len(self.images)}")
+
+    def extract_urls(self):
+        """Full resolution urls of all the results loaded in the page, read by one execute_script call
+
+        Returns:
+            list: urls in the order of the results, empty when the script failed
+        """
+        with self.metrics.timer("extract", **self.labels):
+            try:
+                urls = self.driver.execute_script(self.extract_script) or []
+            except WebDriverException as e:
+                logging.error(f"{self.search_engine}: url extraction script failed {e}")
+                return []
+        return [url for url in urls if url]
+
+    def add_urls(self, urls):
+        """Adds the extracted urls like the per result harvest does, at most num_of_images results are considered
+
+        Args:
+            urls (list): extracted urls
+        """
+        for url in urls[:self.num_of_images]:
+            if self.low_yield():
+                break
+            self.metrics.inc("thumbnails", **self.labels)
+            if self.is_new_url(url):
+                self.add_image(url)
+            self.counter += 1
+
+    def open_results(self):
+        raise NotImplementedError("Override this method!!")
+
+    def harvest_clicks(self):
         raise NotImplementedError("Override this method!!")
 
 
@@ -232,14 +665,40 @@ class BingImageScraper(ImageScraper):
         self.full_res_image_tag = "img.nofocus"
         self.button_close_iframe_tag = "div.close.nofocus"
         self.next_image = "div#navr"
+        self.see_more_image_button_tag = "a.btn_seemore"
+        self.extract_script = BING_EXTRACT_SCRIPT
+        self.http_url = self.url
         super().__init__(*args, **kwargs)
 
-    def scrape(self):
-        """Bing Image scrape function
-        """
+    def http_page_url(self, offset):
+        # first is the 1-based index of the first result of the page
+        return f"{self.http_url}?q={quote_plus(self.query)}&first={offset + 1}&count=35"
+
+    def parse_results(self, page_source, page_url):
+        bs = BeautifulSoup(page_source, features="html.parser")
+        if bs.select_one(self.search_results_tag) is None:
+            raise HarvestError(f"no {self.search_results_tag} in the page")
+        urls = []
+        # same metadata as the bulk extraction, json in the m attribute of the result links
+        for link in bs.select("a.iusc"):
+            try:
+                urls.append(json.loads(link.get("m", ""))["murl"])
+            except (ValueError, KeyError, TypeError):
+                continue
+        return urls
+
+    def open_results(self):
         self.get_url()
         assert self.driver.find_element_by_css_selector(self.search_results_tag).is_displayed(), f"Search results did not load!"
 
+    def extract_urls(self):
+        # the carousal needs no scrolling, the results page does to load the results past the first ones
+        self.load_all_images()
+        return super().extract_urls()
+
+    def harvest_clicks(self):
+        """Bing Image scrape function, steps through the image carousal
+        """
         try:
             # click the first image
             self.driver.find_element_by_css_selector(self.image_thumbnail_tag).click()
@@ -247,19 +706,19 @@ class BingImageScraper(ImageScraper):
             frame_locator = self.driver.find_element_by_css_selector(self.iframe_locator_tag)
             # switch to iframe containing image carousal
             self.wait.until(expected_conditions.frame_to_be_available_and_switch_to_it(frame_locator))
-            time.sleep(1)
+            # wait for the carousal to show the first image
+            img_src = self.wait_for(preview_ready(self.full_res_image_tag), "preview")
+            previous_src = img_src
             # next image button
             next_image = self.driver.find_element_by_css_selector(self.next_image)
             while next_image.is_displayed():  # loop until next image button is no longer visible
-                try:
-                    image = self.driver.find_element_by_css_selector(self.full_res_image_tag)
-                    img_src = image.get_attribute('src')
-                    if img_src is not None:
-                        if "http" in img_src and img_src not in self.list_of_links:
-                            self.images.append(img_src)
-                except Exception as e:
-                    logging.error(f"Not able to get src attribute {e}")
-                next_image.click()
+                if img_src is not None and self.is_new_url(img_src):
+                    self.add_image(img_src)
+                if self.low_yield():
+                    break
+                with self.metrics.timer("thumbnail_click", **self.labels):
+                    next_image.click()
+                self.metrics.inc("thumbnails", **self.labels)
                 # When the last image is reached this object no longer is present in the DOM, so we break the loop
                 try:
                     next_image.is_displayed()
@@ -271,15 +730,12 @@ class BingImageScraper(ImageScraper):
                 if self.counter == self.num_of_images:
                     logging.info(f"Number of scraped images limit {self.num_of_images} reached")
                     break
+                # wait for the carousal to replace the image, None when the next image has the same url
+                img_src = self.wait_for(preview_ready(self.full_res_image_tag, previous_src=previous_src), "preview")
+                previous_src = img_src or previous_src
+                self.pause("thumbnail")
         except Exception as e:
             logging.error(f"Failed to retrieve image! {e}")
-        logging.info(f"Total number of new images found: {len(self.images)}")
-
-        # clean up
-        self.driver.delete_all_cookies()
-        self.driver.close()
-
-        self.download_images()
 
 
 class GoogleImageScraper(ImageScraper):
@@ -291,46 +747,48 @@ class GoogleImageScraper(ImageScraper):
         self.image_thumbnail_tag = "img.rg_i.Q4LuWd"
         self.full_res_image_tag = "img.n3VNCb"
         self.window_pane = "div.l39u4d"
+        self.extract_script = GOOGLE_EXTRACT_SCRIPT
+        # the results are rendered by scripts, there is no http harvest
+        self.http_url = None
         super().__init__(*args, **kwargs)
 
-    def scrape(self):
-        """Google Image scrape function
-        TODO plan to use the image carosual
-        """
+    def open_results(self):
         self.get_url()
         assert self.driver.find_element_by_css_selector(self.search_results_tag).is_displayed(), f"Search results did not load!"
         # load all images in the search results page
         self.load_all_images()
+
+    def harvest_clicks(self):
+        """Google Image scrape function, clicks each thumbnail
+        TODO plan to use the image carosual
+        """
         list_of_elements = self.get_all_elements_from_image_thumbnail()
         logging.info(f"total thumbnail images present {len(list_of_elements)}")
 
+        previous_src = None
         for i, element in enumerate(tqdm(list_of_elements, desc="Scraping google images", ascii=True, ncols=100)):
             # break the loop when number of images is equal to scraped images
             if i == self.num_of_images:
                 logging.info(f"\nNumber of scraped images limit {self.num_of_images} reached")
                 break
+            if self.low_yield():
+                break
             try:
-                element.click()
-                time.sleep(0.5)
-                self.wait.until(expected_conditions.visibility_of_element_located((By.CSS_SELECTOR, self.window_pane)))
-                try:
-                    # 2nd index contains the image url
-                    image = self.driver.find_elements_by_css_selector(self.full_res_image_tag)[1]
-                    img_src = image.get_attribute('src')
-                    if img_src is not None:
-                        if "http" in img_src and img_src not in self.list_of_links:
-                            self.images.append(img_src)
-                except Exception as e:
-                    logging.error(f"Not able to get src attribute {e}")
+                self.metrics.inc("thumbnails", **self.labels)
+                with self.metrics.timer("thumbnail_click", **self.labels):
+                    element.click()
+                    self.wait.until(expected_conditions.visibility_of_element_located((By.CSS_SELECTOR, self.window_pane)))
+                    # 2nd index contains the image url, it shows the thumbnail as a data uri until the full resolution url is known
+                    img_src = self.wait_for(preview_ready(self.full_res_image_tag, 1, previous_src), "preview")
+                if img_src is None:
+                    logging.error(f"The preview did not show the full resolution image of thumbnail {i}")
+                    continue
+                previous_src = img_src
+                if self.is_new_url(img_src):
+                    self.add_image(img_src)
+                self.pause("thumbnail")
             except Exception as e:
                 logging.error(f"Failed to retrieve image! {e}")
-        logging.info(f"Total number of new images found: {len(self.images)}")
-
-        # clean up
-        self.driver.delete_all_cookies()
-        self.driver.close()
-
-        self.download_images()
 
 
 class YahooImageScraper(ImageScraper):
@@ -341,11 +799,28 @@ class YahooImageScraper(ImageScraper):
         self.see_more_image_button_tag = ".ygbt.more-res"
         self.image_thumbnail_tag = "li[id*=resitem-]"
         self.full_res_image_tag = "a img"
+        self.extract_script = YAHOO_EXTRACT_SCRIPT
+        self.http_url = self.url
         super().__init__(*args, **kwargs)
 
-    def scrape(self):
-        """Yahoo Image scrape function
-        """
+    def http_page_url(self, offset):
+        # b is the 1-based index of the first result of the page
+        return f"{self.http_url}?q={quote_plus(self.query)}&b={offset + 1}"
+
+    def parse_results(self, page_source, page_url):
+        bs = BeautifulSoup(page_source, features="html.parser")
+        if bs.select_one(self.search_results_tag) is None:
+            raise HarvestError(f"no {self.search_results_tag} in the page")
+        urls = []
+        # same url as the browser harvest, the src of the first image of each result up to the first &
+        for item in bs.select(self.image_thumbnail_tag):
+            image = item.select_one(self.full_res_image_tag)
+            src = image and (image.get("src") or image.get("data-src"))
+            if src:
+                urls.append(urljoin(page_url, src).split("&")[0])
+        return urls
+
+    def open_results(self):
         self.get_url()
 
         # Yahoo refuse cookie on the initial popup
@@ -360,10 +835,13 @@ class YahooImageScraper(ImageScraper):
 
         assert self.driver.find_element_by_css_selector(self.search_results_tag).is_displayed(), f"Search results did not load!"
 
-        time.sleep(2)
+        self.wait_for(lambda driver: driver.find_elements_by_css_selector(self.image_thumbnail_tag), "results")
         # load all images in the search results page
         self.load_all_images()
 
+    def harvest_clicks(self):
+        """Yahoo Image scrape function, reads the src of each result
+        """
         list_of_elements = self.get_all_elements_from_image_thumbnail()
         logging.info(f"total thumbnail images present {len(list_of_elements)}")
 
@@ -372,6 +850,9 @@ class YahooImageScraper(ImageScraper):
             if i == self.num_of_images:
                 logging.info(f"Number of scraped images limit {self.num_of_images} reached")
                 break
+            if self.low_yield():
+                break
+            self.metrics.inc("thumbnails", **self.labels)
             try:
                 images = element.find_elements_by_css_selector(self.full_res_image_tag)
                 if not images:
@@ -379,16 +860,9 @@ class YahooImageScraper(ImageScraper):
                 # 1st index is the source image with high resolution
                 img_src = images[0].get_attribute('src')
                 if img_src is not None:
-                    if "http" in img_src and img_src not in self.list_of_links:
-                        img_src = img_src.split("&")[0]  # strip everything after & to get full resolution link
-                        self.images.append(img_src)
+                    img_src = img_src.split("&")[0]  # strip everything after & to get full resolution link
+                    if self.is_new_url(img_src):
+                        self.add_image(img_src)
             except Exception as e:
                 logging.error(f"not able to get src attribute {e}")
             self.counter += 1
-        logging.info(f"Total number of new images found: {len(self.images)}")
-
-        # clean up
-        self.driver.delete_all_cookies()
-        self.driver.close()
-
-        self.download_images()
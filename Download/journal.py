@@ -0,0 +1,136 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_JOURNAL = "download_journal.sqlite"
+# a job is "running" while its urls are harvested, "harvested" once the harvest completed and its downloads are pending,
+# then "done" or "failed"
+JOB_STATES = ("running", "harvested", "done", "failed")
+
+
+class Journal:
+    def __init__(self, journal_file=DEFAULT_JOURNAL, batch_size=20):
+        """Persistent journal of the (query, directory, engine) jobs of download.py runs.
+        Records the state of every job and the urls harvested but not downloaded yet, so a run that died
+        can be resumed: finished jobs are skipped and the pending urls are downloaded without a browser.
+        The url changes are buffered and written every batch_size changes and on every job state change.
+
+        Args:
+            journal_file (str): path of the sqlite database
+            batch_size (int): number of buffered url changes before they are written to the database
+        """
+        self.journal_file = journal_file
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.added = list()
+        self.removed = list()
+        # the journal is shared by the jobs and the download workers, access is serialized with the lock
+        self.connection = sqlite3.connect(journal_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS jobs (engine TEXT NOT NULL, directory TEXT NOT NULL, query TEXT NOT NULL, "
+                                "state TEXT NOT NULL, counts TEXT, error TEXT, updated REAL NOT NULL, PRIMARY KEY (engine, directory, query))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pending_urls (engine TEXT NOT NULL, directory TEXT NOT NULL, query TEXT NOT NULL, "
+                                "url TEXT NOT NULL, added REAL NOT NULL, PRIMARY KEY (engine, directory, query, url))")
+        self.connection.commit()
+
+    @staticmethod
+    def key(job):
+        return job.engine, os.path.normpath(job.directory), job.query
+
+    def reset(self):
+        """Forgets the jobs and pending urls of the previous runs"""
+        with self.lock, self.connection:
+            self.added.clear()
+            self.removed.clear()
+            self.connection.execute("DELETE FROM jobs")
+            self.connection.execute("DELETE FROM pending_urls")
+
+    def state(self, job):
+        """State of the job in the journal, None when the job never started"""
+        with self.lock:
+            row = self.connection.execute("SELECT state FROM jobs WHERE engine = ? AND directory = ? AND query = ?", self.key(job)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_state(self, job, state, counts=None, error=None):
+        """Records the state of the job, the buffered url changes are written in the same transaction
+
+        Args:
+            job (Job): job of download.py
+            state (str): one of JOB_STATES
+            counts (dict): counts returned by the job
+            error (str): error of a failed job
+        """
+        assert state in JOB_STATES, f"state must be one of {JOB_STATES}"
+        with self.lock, self.connection:
+            self.write_urls()
+            self.connection.execute("INSERT OR REPLACE INTO jobs (engine, directory, query, state, counts, error, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    self.key(job) + (state, json.dumps(counts) if counts is not None else None, error, time.time()))
+            if state == "done":
+                self.connection.execute("DELETE FROM pending_urls WHERE engine = ? AND directory = ? AND query = ?", self.key(job))
+
+    def add_url(self, job, url):
+        """Records a harvested url, pending until url_done is called"""
+        with self.lock:
+            self.added.append(self.key(job) + (url, time.time()))
+            if len(self.added) + len(self.removed) >= self.batch_size:
+                self.flush()
+
+    def url_done(self, job, url):
+        """Records that the download of the url finished, whatever its outcome"""
+        with self.lock:
+            self.removed.append(self.key(job) + (url,))
+            if len(self.added) + len(self.removed) >= self.batch_size:
+                self.flush()
+
+    def write_urls(self):
+        # called with the lock held, in a transaction. Additions first, a url can be added and done in the same batch
+        self.connection.executemany("INSERT OR IGNORE INTO pending_urls (engine, directory, query, url, added) VALUES (?, ?, ?, ?, ?)", self.added)
+        self.connection.executemany("DELETE FROM pending_urls WHERE engine = ? AND directory = ? AND query = ? AND url = ?", self.removed)
+        self.added.clear()
+        self.removed.clear()
+
+    def flush(self):
+        """Writes the buffered url changes in a single transaction"""
+        with self.lock, self.connection:
+            self.write_urls()
+
+    def pending_urls(self, job):
+        """Urls harvested by the job whose download did not finish, in the harvest order"""
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute("SELECT url FROM pending_urls WHERE engine = ? AND directory = ? AND query = ? ORDER BY added",
+                                           self.key(job)).fetchall()
+        return [url for (url,) in rows]
+
+    def job_journal(self, job):
+        """Journal bound to a job, handed to the scraper of the job"""
+        return JobJournal(self, job)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+class JobJournal:
+    def __init__(self, journal, job):
+        """Records the urls and the harvest state of a single job, see Journal
+
+        Args:
+            journal (Journal): journal of the run
+            job (Job): job of download.py
+        """
+        self.journal = journal
+        self.job = job
+
+    def add_url(self, url):
+        self.journal.add_url(self.job, url)
+
+    def url_done(self, url):
+        self.journal.url_done(self.job, url)
+
+    def harvested(self):
+        self.journal.set_state(self.job, "harvested")
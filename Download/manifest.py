@@ -0,0 +1,148 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+MANIFEST_FILE = "manifest.sqlite"
+# counter row holding the sequence number of all the files in the directory, used to pick the shard
+SEQUENCE_COUNTER = ""
+
+
+def to_signed(value):
+    """sqlite integers are signed 64 bits, the unsigned 64 bits hashes are stored in two's complement"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class Manifest:
+    def __init__(self, directory, shard_size=None):
+        """Per directory manifest of the downloaded images.
+        Records the index, source url, engine, query, byte size, sha256, perceptual hash and store object of every file and hands out the
+        file indices from counters stored in the database, so the directory is never listed to find the next index.
+        A record is committed as soon as its file is saved, so the manifest never misses a file that is in the directory.
+
+        Args:
+            directory (str): image directory, the manifest file is created inside it
+            shard_size (int): number of files per sub directory, None to save all the files in directory
+        """
+        self.directory = directory
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        manifest_file = os.path.join(directory, MANIFEST_FILE)
+        is_new = not os.path.isfile(manifest_file)
+        # several scrapers, threads or processes, can write to the same directory: sqlite serializes the writers
+        self.connection = sqlite3.connect(manifest_file, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS counters (file_format TEXT PRIMARY KEY, next_index INTEGER NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (file_name TEXT PRIMARY KEY, file_format TEXT NOT NULL, "
+                                "idx INTEGER NOT NULL, url TEXT, engine TEXT, query TEXT, size INTEGER, sha256 TEXT, created REAL, dhash INTEGER, object TEXT)")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if "dhash" not in columns:  # manifest created before the near duplicate check
+            self.connection.execute("ALTER TABLE files ADD COLUMN dhash INTEGER")
+        if "object" not in columns:  # manifest created before the object store
+            self.connection.execute("ALTER TABLE files ADD COLUMN object TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        if is_new:
+            self.seed_counters()
+
+    def seed_counters(self):
+        """Directories created before the manifest already contain images.
+        They are listed once, when the manifest is created, to start the counters after the highest index found.
+        """
+        last_index = dict()
+        count = 0
+        for entry in os.scandir(self.directory):
+            name, ext = os.path.splitext(entry.name)
+            file_format, _, index = name.rpartition("_")
+            if not entry.is_file() or ext != ".jpg" or not index.isdigit():
+                continue
+            # numerical comparison, a lexicographic sort breaks once the index has more digits than the zero padding
+            last_index[file_format] = max(last_index.get(file_format, 0), int(index))
+            count += 1
+        rows = [(file_format, index + 1) for file_format, index in last_index.items()]
+        rows.append((SEQUENCE_COUNTER, count))
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany("INSERT OR IGNORE INTO counters (file_format, next_index) VALUES (?, ?)", rows)
+            self.connection.execute("COMMIT")
+        if count:
+            logging.info(f"Manifest created for {count} existing images in {self.directory}")
+
+    def reserve(self, file_format):
+        """Atomically hands out the next free index for the file format
+
+        Args:
+            file_format (str): file name prefix, {index}_{engine}_{query}
+
+        Returns:
+            tuple: (index, sequence) index of the file for this file format and sequence number of the file in the directory
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                reserved = list()
+                for counter, start in ((file_format, 1), (SEQUENCE_COUNTER, 0)):
+                    row = self.connection.execute("SELECT next_index FROM counters WHERE file_format = ?", (counter,)).fetchone()
+                    value = row[0] if row is not None else start
+                    self.connection.execute("INSERT OR REPLACE INTO counters (file_format, next_index) VALUES (?, ?)", (counter, value + 1))
+                    reserved.append(value)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return tuple(reserved)
+
+    def file_path(self, file_name, sequence):
+        """Path of the file, inside its shard sub directory when sharding is enabled
+
+        Args:
+            file_name (str): image file name
+            sequence (int): sequence number of the file in the directory
+
+        Returns:
+            str: relative path of the file from the directory
+        """
+        if not self.shard_size:
+            return file_name
+        return os.path.join(str(sequence // self.shard_size).zfill(4), file_name)
+
+    def add(self, file_name, file_format, index, url, engine, query, size, sha256, dhash=None, object_path=None):
+        """Records a saved file, in its own transaction
+
+        Args:
+            file_name (str): path of the file relative to the directory
+            file_format (str): file name prefix
+            index (int): index of the file
+            url (str): source url
+            engine (str): search engine
+            query (str): search query
+            size (int): size of the file in bytes
+            sha256 (str): hex digest of the file content
+            dhash (int): 64 bits difference hash of the image, None when it was not computed
+            object_path (str): object of the content store the file is a hard link to, None when the store is not used
+        """
+        if dhash is not None:
+            dhash = to_signed(dhash)
+        # the file is already in the directory, its record is not buffered so a crash can not lose it
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO files (file_name, file_format, idx, url, engine, query, size, sha256, created, dhash, object) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (file_name, file_format, index, url, engine, query, size, sha256, time.time(), dhash, object_path))
+
+    def hashes(self):
+        """Perceptual hashes of the files recorded in the manifest
+
+        Returns:
+            list: (file_name, dhash) of the files having a hash
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT file_name, dhash FROM files WHERE dhash IS NOT NULL").fetchall()
+        return [(file_name, to_unsigned(dhash)) for file_name, dhash in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,187 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# prefix of the exported metric names
+PREFIX = "image_scraper_"
+
+
+def escape_label(value):
+    """Escapes a label value of the Prometheus text format"""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    def __init__(self, event_file=None, run_id=None):
+        """Counters and timers of a run, labelled e.g. by search engine and query.
+        Every observation is appended to a json lines event log when event_file is given,
+        the aggregates are written in the Prometheus text format at the end of the run.
+        Metrics are shared by the scrapers and the download workers, all the methods are thread safe.
+
+        Args:
+            event_file (str): json lines file the events are appended to, None to only keep the aggregates
+            run_id (str): identifier of the run added to every event, the start time by default
+        """
+        self.lock = threading.Lock()
+        self.run_id = run_id or time.strftime("%Y%m%d_%H%M%S")
+        # (name, labels) -> value, labels is a sorted tuple of (label, value)
+        self.counters = defaultdict(float)
+        # (name, labels) -> [count, total seconds, max seconds]
+        self.timers = dict()
+        self.events = open(event_file, "a") if event_file else None
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def log_event(self, kind, name, value, labels):
+        # called with the lock held
+        if self.events is not None:
+            event = {"run": self.run_id, "time": time.time(), "type": kind, "name": name, "value": value}
+            event.update(labels)
+            self.events.write(json.dumps(event) + "\n")
+
+    def inc(self, name, value=1, **labels):
+        """Adds value to a counter
+
+        Args:
+            name (str): counter name, e.g. "download_bytes"
+            value (float): increment
+            labels: labels of the counter, e.g. engine="bing"
+        """
+        with self.lock:
+            self.counters[self.key(name, labels)] += value
+            self.log_event("counter", name, value, labels)
+
+    def observe(self, name, seconds, **labels):
+        """Records a duration
+
+        Args:
+            name (str): timer name, e.g. "page_load"
+            seconds (float): measured duration
+            labels: labels of the timer, e.g. engine="bing"
+        """
+        with self.lock:
+            timer = self.timers.setdefault(self.key(name, labels), [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            self.log_event("timer", name, seconds, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Context manager recording the duration of its block, also when the block raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def prometheus(self):
+        """Aggregates in the Prometheus text format, counters as `_total` and timers as summaries with a `_max` gauge
+
+        Returns:
+            str: exposition text
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        last = None
+        for (name, labels), value in counters:
+            metric = PREFIX + name + "_total"
+            if metric != last:
+                lines.append(f"# TYPE {metric} counter")
+                last = metric
+            lines.append(f"{metric}{format_labels(labels)} {int(value) if value.is_integer() else value}")
+        for suffix, kind, field in (("_seconds", "summary", None), ("_seconds_max", "gauge", 2)):
+            last = None
+            for (name, labels), (count, total, longest) in timers:
+                metric = PREFIX + name + suffix
+                if metric != last:
+                    lines.append(f"# TYPE {metric} {kind}")
+                    last = metric
+                if field is None:
+                    lines.append(f"{metric}_count{format_labels(labels)} {count}")
+                    lines.append(f"{metric}_sum{format_labels(labels)} {total:.6f}")
+                else:
+                    lines.append(f"{metric}{format_labels(labels)} {longest:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Writes the aggregates to path, replaced atomically so a textfile collector never reads a partial file
+
+        Args:
+            path (str): .prom file
+        """
+        fd, temp_file = tempfile.mkstemp(prefix=".", suffix=".prom", dir=os.path.dirname(path) or ".")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.prometheus())
+        os.replace(temp_file, path)
+
+    def log_summary(self):
+        """Logs the total time and count of each timer and the total of each counter, summed over the labels"""
+        totals = defaultdict(lambda: [0, 0.0])
+        counters = defaultdict(float)
+        with self.lock:
+            for (name, _), (count, total, _) in self.timers.items():
+                totals[name][0] += count
+                totals[name][1] += total
+            for (name, _), value in self.counters.items():
+                counters[name] += value
+        logging.info("Timings:")
+        for name, (count, total) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            logging.info(f"{name}: {total:.1f}s in {count} calls, {total / count * 1000:.0f} ms per call")
+        logging.info(f"Counters: {dict((name, round(value, 3)) for name, value in sorted(counters.items()))}")
+
+    def close(self):
+        with self.lock:
+            if self.events is not None:
+                self.events.close()
+                self.events = None
+
+
+@contextmanager
+def profile(path):
+    """Profiles the block with cProfile, in the calling thread and in every thread started inside the block.
+    The stats of all the threads are merged and dumped to path, to be read with `python -m pstats path` or snakeviz.
+
+    Args:
+        path (str): output file of the stats
+    """
+    profiles = []
+    lock = threading.Lock()
+
+    def start_thread_profile(frame, event, arg):
+        # called on the first event of a new thread, the profiler replaces this function for the rest of the thread
+        thread_profile = cProfile.Profile()
+        with lock:
+            profiles.append(thread_profile)
+        thread_profile.enable()
+
+    main_profile = cProfile.Profile()
+    profiles.append(main_profile)
+    threading.setprofile(start_thread_profile)
+    main_profile.enable()
+    try:
+        yield
+    finally:
+        main_profile.disable()
+        threading.setprofile(None)
+        with lock:
+            stats = pstats.Stats(*profiles)
+        stats.dump_stats(path)
+        logging.info(f"profile of {len(profiles)} threads written to {path}")
@@ -0,0 +1,178 @@
+import hashlib
+import threading
+
+import numpy as np
+import cv2
+
+from Download.downloader import NearDuplicateImage
+from Download.quality_filter import decode_image
+
+# the hash compares each pixel with its right neighbour on a 9x8 grayscale thumbnail: 64 bits
+HASH_SIZE = 8
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def dhash(image):
+    """Difference hash of the image, same algorithm and bit order as the DHash of imagededup used by
+    `Duplicates Removal/remove_duplicates.py`, up to the resampling filter of the thumbnail.
+
+    Args:
+        image (numpy.ndarray): decoded BGR or grayscale image
+
+    Returns:
+        int: 64 bits hash
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(image, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distances(values, value):
+    """Number of differing bits between each of the values and value
+
+    Args:
+        values (numpy.ndarray): uint64 hashes
+        value (int): hash
+
+    Returns:
+        numpy.ndarray: distances
+    """
+    xor = np.ascontiguousarray(values ^ np.uint64(value))
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(xor)
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HashIndex:
+    def __init__(self, manifest):
+        """Perceptual hashes of the images of a directory, shared by the scrapers saving to the directory.
+        Loaded from the manifest, which stores the hash of every image saved with the near duplicate check.
+        Accepted images are claimed in the index as soon as they are checked, so two near duplicates downloaded
+        concurrently can not both be saved.
+
+        Args:
+            manifest (Manifest): manifest of the directory
+        """
+        self.lock = threading.Lock()
+        self.values = np.zeros(1024, dtype=np.uint64)
+        self.active = np.zeros(1024, dtype=bool)
+        self.labels = list()
+        # sha256 of the images checked but not saved yet -> row
+        self.pending = dict()
+        for file_name, value in manifest.hashes():
+            self.append(value, file_name)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def append(self, value, label):
+        row = len(self.labels)
+        if row == len(self.values):
+            self.values = np.concatenate([self.values, np.zeros_like(self.values)])
+            self.active = np.concatenate([self.active, np.zeros_like(self.active)])
+        self.values[row] = value
+        self.active[row] = True
+        self.labels.append(label)
+        return row
+
+    def claim(self, value, max_distance, key, source=None):
+        """Looks for an image within max_distance of the hash, the hash is added to the index when there is none
+
+        Args:
+            value (int): hash of the checked image
+            max_distance (int): max number of differing bits of two near duplicates
+            key (str): sha256 of the checked image, passed to assign() once the image is saved
+            source (str): source url of the checked image, names the claimed hash until assign() replaces it with the file name
+
+        Returns:
+            tuple: (label, distance) of the closest near duplicate, None when the image was claimed
+        """
+        with self.lock:
+            count = len(self.labels)
+            if count:
+                distances = hamming_distances(self.values[:count], value)
+                distances[~self.active[:count]] = 65
+                row = int(np.argmin(distances))
+                if distances[row] <= max_distance:
+                    return self.labels[row], int(distances[row])
+            self.pending[key] = self.append(value, f"the image being saved from {source}" if source else "an image being saved")
+        return None
+
+    def assign(self, key, file_name):
+        """Labels a claimed hash with the name of the saved file
+
+        Args:
+            key (str): sha256 of the image
+            file_name (str): path of the file relative to the directory
+
+        Returns:
+            int: hash of the image, None when the image was not claimed
+        """
+        with self.lock:
+            row = self.pending.pop(key, None)
+            if row is None:
+                return None
+            self.labels[row] = file_name
+            return int(self.values[row])
+
+    def release(self, key):
+        """Drops a claimed hash when the image could not be saved
+
+        Args:
+            key (str): sha256 of the image
+        """
+        with self.lock:
+            row = self.pending.pop(key, None)
+            if row is not None:
+                self.active[row] = False
+
+
+class NearDuplicateFilter:
+    def __init__(self, hash_index, max_distance=10, quality_filter=None):
+        """Rejects the downloaded images close to an image already in the directory, before they are written.
+        Used in place of the quality filter by the download workers, the image is decoded once for both.
+
+        Args:
+            hash_index (HashIndex): hashes of the images of the directory
+            max_distance (int): max number of differing bits of the hashes of two near duplicates
+            quality_filter (QualityFilter): checks applied before the near duplicate check, None to skip them
+        """
+        self.hash_index = hash_index
+        self.max_distance = max_distance
+        self.quality_filter = quality_filter
+
+    def check(self, data, url=None):
+        """Decodes the image, applies the quality filter and claims the hash of the image
+
+        Args:
+            data (bytes-like): content of the downloaded file
+            url (str): source url of the image, names the image in the rejections until it is saved
+
+        Returns:
+            str: reason of the rejection by the quality filter, None when the image is kept
+
+        Raises:
+            NearDuplicateImage: when the image is a near duplicate
+        """
+        image = decode_image(data)
+        if image is None:
+            return "corrupt image"
+        if self.quality_filter is not None:
+            reason = self.quality_filter.check_image(image)
+            if reason is not None:
+                return reason
+        match = self.hash_index.claim(dhash(image), self.max_distance, hashlib.sha256(data).hexdigest(), url)
+        if match is not None:
+            file_name, distance = match
+            raise NearDuplicateImage(f"Image rejected: near duplicate of {file_name} (distance {distance})")
+        return None
+
+    def release(self, sha256):
+        """Drops the hash claimed by check() when the image could not be written
+
+        Args:
+            sha256 (str): hex digest of the content of the image
+        """
+        self.hash_index.release(sha256)
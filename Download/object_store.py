@@ -0,0 +1,84 @@
+import argparse
+import errno
+import logging
+import os
+
+
+class ObjectStore:
+    def __init__(self, root):
+        """Content addressed store of the downloaded images.
+        Every image is stored once, under its sha256 in a directory sharded by the first bytes of the digest,
+        and the files of the image directories are hard links to the objects. Byte identical images saved under
+        several names, directories or engines take the space of a single file and share a single inode.
+        The objects have no extension, so the image listing of the duplicates removal never picks the store.
+
+        Args:
+            root (str): directory of the store, on the same filesystem as the image directories
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def store(self, temp_file, sha256, file_path):
+        """Moves a completed download to file_path, linked to the object of its content.
+        The first file with a given content becomes the object, the next ones are replaced by a link to it.
+
+        Args:
+            temp_file (str): downloaded file, removed or renamed
+            sha256 (str): hex digest of the content of temp_file
+            file_path (str): final path of the image, must not exist
+
+        Returns:
+            bool: True when the content was not in the store yet
+        """
+        object_path = self.object_path(sha256)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        try:
+            # fails when the object exists, so two downloads of the same content racing each other create a single object
+            os.link(temp_file, object_path)
+            os.replace(temp_file, file_path)
+            return True
+        except FileExistsError:
+            pass
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            logging.warning(f"{file_path} is not on the filesystem of the object store {self.root}, saved without link")
+            os.replace(temp_file, file_path)
+            return True
+        os.link(object_path, file_path)
+        os.remove(temp_file)
+        return False
+
+    def collect_garbage(self):
+        """Removes the objects no image links to any more, e.g. after the duplicates were deleted
+
+        Returns:
+            tuple: (number of objects removed, bytes freed)
+        """
+        removed, freed = 0, 0
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                if st.st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+                    freed += st.st_size
+        return removed, freed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance of the content addressed image store")
+    parser.add_argument("command", choices=["gc"], help="gc: remove the objects no image links to")
+    parser.add_argument("cas_dir", help="directory of the store")
+    args = parser.parse_args()
+
+    removed, freed = ObjectStore(args.cas_dir).collect_garbage()
+    print(f"{removed} objects removed, {freed / 1024 / 1024:.1f} MB freed")
+
+
+if __name__ == "__main__":
+    main()
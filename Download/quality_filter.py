@@ -0,0 +1,81 @@
+import os
+import sys
+
+import numpy as np
+import cv2
+
+# the white background measure is the one of the isolated images filter, so the download time and offline filters agree
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Isolated Images Filter"))
+from isolatedfilter import white_ratio
+
+WHITE_BACKGROUND_MODES = ("any", "reject", "only")
+
+
+def decode_image(data):
+    """Decodes the downloaded bytes in memory
+
+    Args:
+        data (bytes-like): content of the downloaded file
+
+    Returns:
+        numpy.ndarray: BGR image, None when the bytes are not a readable image
+    """
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class QualityFilter:
+    def __init__(self, min_width=0, min_height=0, white_background="any", tolerance=10, ratio=30):
+        """Checks applied to the downloaded bytes before the image is written to its directory.
+        The image is decoded once, in memory, instead of being read back from the disk by a separate pass.
+
+        Args:
+            min_width (int): images narrower than this are rejected
+            min_height (int): images shorter than this are rejected
+            white_background (str): "any" keeps all images, "reject" rejects the isolated images (white background), "only" keeps only them
+            tolerance (float): a pixel is white when 255 minus the mean of its channels is at most tolerance
+            ratio (float): min percentage of white pixels for an image to be isolated
+        """
+        assert white_background in WHITE_BACKGROUND_MODES, f"white_background must be one of {WHITE_BACKGROUND_MODES}"
+        self.min_width = min_width
+        self.min_height = min_height
+        self.white_background = white_background
+        self.tolerance = tolerance
+        self.ratio = ratio
+
+    def check(self, data, url=None):
+        """Decodes the image and applies the checks
+
+        Args:
+            data (bytes-like): content of the downloaded file
+            url (str): source url of the image, not used by the checks
+
+        Returns:
+            str: reason of the rejection, None when the image is kept
+        """
+        image = decode_image(data)
+        if image is None:
+            return "corrupt image"
+        return self.check_image(image)
+
+    def release(self, sha256):
+        """Called when a checked image could not be written, the checks keep no state"""
+
+    def check_image(self, image):
+        """Applies the checks to an image already decoded
+
+        Args:
+            image (numpy.ndarray): decoded image
+
+        Returns:
+            str: reason of the rejection, None when the image is kept
+        """
+        height, width = image.shape[:2]
+        if width < self.min_width or height < self.min_height:
+            return f"resolution {width}x{height} below {self.min_width}x{self.min_height}"
+        if self.white_background != "any":
+            isolated = white_ratio(image, self.tolerance) >= self.ratio
+            if isolated and self.white_background == "reject":
+                return "white background"
+            if not isolated and self.white_background == "only":
+                return "no white background"
+        return None
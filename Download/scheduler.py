@@ -0,0 +1,191 @@
+import logging
+import time
+from collections import Counter, defaultdict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# a (query, engine) pair to scrape, line is the line of the queries file and index the position of the query in the line
+Job = namedtuple("Job", ["line", "index", "query", "directory", "engine"])
+LOW_YIELD_POLICIES = ("stop", "defer")
+
+
+class YieldTracker:
+    def __init__(self, min_yield=0, patience=3):
+        """Tracks the share of new urls found by each query of a line, per engine.
+        The variants of an expanded query line mostly find the same images, once `patience` variants in a row
+        found less than min_yield new urls on an engine, the remaining variants of the line are low yield on that engine.
+
+        Args:
+            min_yield (float): min share of new urls among the urls found by a job, 0 disables the tracking
+            patience (int): number of consecutive low yield jobs of a line after which its remaining jobs are low yield
+        """
+        self.min_yield = min_yield
+        self.patience = patience
+        self.low_streak = Counter()
+        self.variants = list()
+
+    @staticmethod
+    def job_yield(counts):
+        """Share of new urls among the urls found by the job, urls already downloaded do not count as new"""
+        seen = counts.get("found", 0) + counts.get("known", 0)
+        return counts.get("found", 0) / seen if seen else 0.0
+
+    def record(self, job, counts, status="done"):
+        """Records the counts of a finished job, or of a skipped job with empty counts
+
+        Args:
+            job (Job): finished job
+            counts (dict): counts returned by the job
+            status (str): "done", "deferred", "failed" or "skipped"
+        """
+        if counts.get("stopped_early") and status == "done":
+            status = "stopped early"
+        self.variants.append((job, counts, status))
+        if not self.min_yield or status == "skipped":
+            return
+        if status != "failed" and self.job_yield(counts) < self.min_yield:
+            self.low_streak[(job.line, job.engine)] += 1
+        else:
+            self.low_streak[(job.line, job.engine)] = 0
+
+    def exhausted(self, job):
+        """True when the job belongs to a line whose last variants had a low yield on the job engine"""
+        return self.min_yield > 0 and self.low_streak[(job.line, job.engine)] >= self.patience
+
+    def log_report(self):
+        """Logs the new urls and the yield of each query and engine"""
+        logging.info("Yield per query:")
+        for job, counts, status in sorted(self.variants, key=lambda v: (v[0].line, v[0].index, v[0].engine)):
+            found = counts.get("found", 0)
+            seen = found + counts.get("known", 0)
+            logging.info(f"line {job.line + 1} '{job.query}' {job.engine}: {found} new of {seen} urls "
+                         f"({self.job_yield(counts):.0%}), {counts.get('downloaded', 0)} downloaded, {status}")
+
+
+class Scheduler:
+    def __init__(self, run_job, workers=1, engine_concurrency=1, engine_interval=0, yield_tracker=None, low_yield="stop"):
+        """Runs the scraping jobs concurrently.
+        Each engine has its own queue of jobs, a job is started when a worker is free, the engine has less than
+        engine_concurrency jobs running and engine_interval seconds passed since the last job started on that engine.
+
+        Args:
+            run_job (callable): function called with a Job, returns a dict of counts
+            workers (int): max number of jobs running at the same time
+            engine_concurrency (int): max number of jobs running at the same time on the same engine
+            engine_interval (float): min number of seconds between two jobs started on the same engine
+            yield_tracker (YieldTracker): yield of the finished jobs, None to run all the jobs
+            low_yield (str): "stop" skips the low yield jobs, "defer" runs them after the other jobs of their engine
+        """
+        assert low_yield in LOW_YIELD_POLICIES, f"low_yield must be one of {LOW_YIELD_POLICIES}"
+        self.run_job = run_job
+        self.workers = workers
+        self.engine_concurrency = engine_concurrency
+        self.engine_interval = engine_interval
+        self.yield_tracker = yield_tracker
+        self.low_yield = low_yield
+        self.deferred = set()
+
+    def next_job(self, queues, running, last_start):
+        """Picks the next job that can be started, engines are visited in turn so no engine is starved
+
+        Returns:
+            tuple: (job, wait_time) job is None when no job can start now, wait_time is the delay until an engine pacing expires
+        """
+        now = time.monotonic()
+        wait_time = None
+        for engine in sorted(queues, key=lambda e: last_start.get(e, 0)):
+            if not queues[engine] or running[engine] >= self.engine_concurrency:
+                continue
+            ready_at = last_start.get(engine, float("-inf")) + self.engine_interval
+            if ready_at > now:
+                wait_time = ready_at - now if wait_time is None else min(wait_time, ready_at - now)
+                continue
+            job = self.pop_job(queues[engine])
+            if job is not None:
+                return job, None
+        return None, wait_time
+
+    def pop_job(self, queue):
+        """Next job of an engine queue, the low yield jobs are skipped or moved to the end of the queue
+
+        Args:
+            queue (collections.deque): jobs of an engine
+
+        Returns:
+            Job: job to start, None when all the jobs left were skipped
+        """
+        while queue:
+            job = queue.popleft()
+            if self.yield_tracker is None or job in self.deferred or not self.yield_tracker.exhausted(job):
+                return job
+            if self.low_yield == "defer":
+                self.deferred.add(job)
+                queue.append(job)
+            else:
+                logging.info(f"{job.engine}: skipping query '{job.query}', the previous queries of the line found few new images")
+                self.yield_tracker.record(job, {}, status="skipped")
+        return None
+
+    def run(self, jobs):
+        """Runs all the jobs and logs a summary
+
+        Args:
+            jobs (list): list of Job
+
+        Returns:
+            dict: counts summed per engine
+        """
+        queues = defaultdict(deque)
+        for job in jobs:
+            queues[job.engine].append(job)
+        running = Counter()
+        last_start = dict()
+        summary = defaultdict(Counter)
+        futures = dict()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while futures or any(queues.values()):
+                wait_time = None
+                while len(futures) < self.workers:
+                    job, wait_time = self.next_job(queues, running, last_start)
+                    if job is None:
+                        break
+                    running[job.engine] += 1
+                    last_start[job.engine] = time.monotonic()
+                    futures[executor.submit(self.run_job, job)] = job
+                if not futures:  # nothing running, the next jobs are waiting for their engine pacing
+                    time.sleep(wait_time or 0)
+                    continue
+                done, _ = wait(futures, timeout=wait_time, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = futures.pop(future)
+                    running[job.engine] -= 1
+                    summary[job.engine]["jobs"] += 1
+                    try:
+                        counts = future.result() or {}
+                        summary[job.engine].update(counts)
+                        status = "deferred" if job in self.deferred else "done"
+                    except Exception as e:
+                        logging.error(f"{job.engine}: job for query '{job.query}' failed! {e}")
+                        summary[job.engine]["failed_jobs"] += 1
+                        counts, status = {}, "failed"
+                    if self.yield_tracker is not None:
+                        self.yield_tracker.record(job, counts, status)
+        if self.yield_tracker is not None:
+            for job, _, status in self.yield_tracker.variants:
+                if status == "skipped":
+                    summary[job.engine]["skipped_jobs"] += 1
+            self.yield_tracker.log_report()
+        self.log_summary(summary)
+        return summary
+
+    def log_summary(self, summary):
+        """Logs the counts per engine and the total
+
+        Args:
+            summary (dict): counts per engine
+        """
+        total = Counter()
+        logging.info("Summary:")
+        for engine, counts in sorted(summary.items()):
+            total.update(counts)
+            logging.info(f"{engine}: {dict(counts)}")
+        logging.info(f"total: {dict(total)}")
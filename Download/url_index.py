@@ -0,0 +1,207 @@
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+DEFAULT_URL_INDEX = "url_index.sqlite"
+# query parameters that only track the visitor and never change the image served
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "igshid", "mc_cid", "mc_eid", "_ga", "ref", "ref_src", "spm"}
+DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+
+def normalize_url(url):
+    """Normalize the url so that the same image gets the same key:
+    http and https are unified, host lower cased, default port, fragment and tracking parameters removed
+    and the remaining query parameters sorted.
+
+    Args:
+        url (str): image url
+
+    Returns:
+        str: normalized url
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if scheme in DEFAULT_PORTS and netloc.endswith(DEFAULT_PORTS[scheme]):
+        netloc = netloc[:-len(DEFAULT_PORTS[scheme])]
+    if scheme == "http":
+        scheme = "https"
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if not k.lower().startswith("utm_") and k.lower() not in TRACKING_PARAMS]
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(sorted(query)), ""))
+
+
+def url_key(url):
+    """Fixed size hash of the normalized url, used as the index key
+
+    Args:
+        url (str): image url
+
+    Returns:
+        bytes: 16 bytes digest
+    """
+    return hashlib.blake2b(normalize_url(url).encode("utf-8"), digest_size=16).digest()
+
+
+class UrlIndex:
+    def __init__(self, index_file=DEFAULT_URL_INDEX, global_scope=False, batch_size=500):
+        """Persistent index of the urls already fetched, shared by all the engines and directories.
+        Urls are keyed by the hash of their normalized form, lookups are a primary key search and
+        new urls are buffered and written in batches.
+
+        Args:
+            index_file (str): path of the sqlite database
+            global_scope (bool): a url found in any directory counts as seen, by default urls are checked per directory
+            batch_size (int): number of buffered urls before they are written to the database
+        """
+        self.index_file = index_file
+        self.global_scope = global_scope
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.pending = dict()
+        self.pending_keys = set()
+        # the index is shared by the scrapers and the download workers, access is serialized with the lock
+        self.connection = sqlite3.connect(index_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS urls (key BLOB NOT NULL, directory TEXT NOT NULL, url TEXT NOT NULL, "
+                                "status TEXT NOT NULL, PRIMARY KEY (key, directory)) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS imported_files (path TEXT PRIMARY KEY, offset INTEGER NOT NULL)")
+        self.connection.commit()
+
+    def contains(self, url, directory):
+        """Checks whether the url was already recorded
+
+        Args:
+            url (str): image url
+            directory (str): directory the image is saved to
+
+        Returns:
+            bool: True when the url is in the index
+        """
+        key = url_key(url)
+        directory = os.path.normpath(directory)
+        with self.lock:
+            if self.global_scope:
+                if key in self.pending_keys:
+                    return True
+                row = self.connection.execute("SELECT 1 FROM urls WHERE key = ? LIMIT 1", (key,)).fetchone()
+            else:
+                if (key, directory) in self.pending:
+                    return True
+                row = self.connection.execute("SELECT 1 FROM urls WHERE key = ? AND directory = ?", (key, directory)).fetchone()
+        return row is not None
+
+    def add(self, url, directory, status="downloaded"):
+        """Buffers the url, the buffer is written to the database every batch_size urls
+
+        Args:
+            url (str): image url
+            directory (str): directory the image is saved to
+            status (str): outcome recorded for the url
+        """
+        key = url_key(url)
+        with self.lock:
+            self.pending[(key, os.path.normpath(directory))] = (url, status)
+            self.pending_keys.add(key)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Writes the buffered urls in a single transaction"""
+        with self.lock:
+            if not self.pending:
+                return
+            rows = [(key, directory, url, status) for (key, directory), (url, status) in self.pending.items()]
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO urls (key, directory, url, status) VALUES (?, ?, ?, ?)", rows)
+            self.pending.clear()
+            self.pending_keys.clear()
+
+    def import_links_file(self, links_file, directory):
+        """Imports the urls of a links.txt file. The file is append only, so only the lines added
+        since the last import are read.
+
+        Args:
+            links_file (str): path of the links.txt file
+            directory (str): directory the links belong to
+
+        Returns:
+            int: number of urls read from the file
+        """
+        if not os.path.isfile(links_file):
+            return 0
+        path = os.path.abspath(links_file)
+        with self.lock:
+            row = self.connection.execute("SELECT offset FROM imported_files WHERE path = ?", (path,)).fetchone()
+            offset = row[0] if row is not None else 0
+            if offset > os.path.getsize(links_file):  # file was truncated or replaced, import it again
+                offset = 0
+            with open(links_file, "rb") as f:
+                f.seek(offset)
+                lines = f.read().decode("utf-8", errors="ignore").splitlines()
+                offset = f.tell()
+            directory = os.path.normpath(directory)
+            rows = [(url_key(url), directory, url.strip(), "downloaded") for url in lines if url.strip()]
+            with self.connection:
+                self.connection.executemany("INSERT OR IGNORE INTO urls (key, directory, url, status) VALUES (?, ?, ?, ?)", rows)
+                self.connection.execute("INSERT OR REPLACE INTO imported_files (path, offset) VALUES (?, ?)", (path, offset))
+        if rows:
+            logging.info(f"Imported {len(rows)} urls from {links_file}")
+        return len(rows)
+
+    def export_links_file(self, directory, links_file):
+        """Writes the urls recorded for the directory to a links.txt file
+
+        Args:
+            directory (str): directory the links belong to
+            links_file (str): path of the links.txt file written
+
+        Returns:
+            int: number of urls written
+        """
+        self.flush()
+        count = 0
+        with self.lock:
+            with open(links_file, "w") as f:
+                rows = self.connection.execute("SELECT url FROM urls WHERE directory = ? AND status = 'downloaded'",
+                                               (os.path.normpath(directory),))
+                for (url,) in rows:
+                    f.write(f"\n{url}")
+                    count += 1
+            # the urls of the new file are all in the index, the next import starts after them
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO imported_files (path, offset) VALUES (?, ?)",
+                                        (os.path.abspath(links_file), os.path.getsize(links_file)))
+        return count
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import links.txt files into the url index or write them back out")
+    parser.add_argument("command", choices=["import", "export"], help="import the links.txt files or export them from the index")
+    parser.add_argument("directories", nargs="+", help="image directories containing the links.txt file")
+    parser.add_argument("--url_index", type=str, default=DEFAULT_URL_INDEX, help="path to the url index database")
+    args = parser.parse_args()
+
+    url_index = UrlIndex(args.url_index)
+    for directory in args.directories:
+        links_file = os.path.join(directory, "links.txt")
+        if args.command == "import":
+            count = url_index.import_links_file(links_file, directory)
+        else:
+            count = url_index.export_links_file(directory, links_file)
+        print(f"{directory}: {count} urls")
+    url_index.close()
+
+
+if __name__ == "__main__":
+    main()
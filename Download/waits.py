@@ -0,0 +1,75 @@
+import random
+
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+
+THROTTLE_POLICIES = ("none", "human")
+
+
+class content_grew:
+    def __init__(self, last_height, locator=None, last_count=0):
+        """Condition of WebDriverWait, true once the page got taller or shows more thumbnails than before.
+
+        Args:
+            last_height (int): document height before the scroll or click
+            locator (str): css selector of the thumbnails, None to only watch the height
+            last_count (int): number of thumbnails before the scroll or click
+        """
+        self.last_height = last_height
+        self.locator = locator
+        self.last_count = last_count
+
+    def __call__(self, driver):
+        height = driver.execute_script("return document.body.scrollHeight")
+        count = len(driver.find_elements_by_css_selector(self.locator)) if self.locator else 0
+        if height != self.last_height or count > self.last_count:
+            return height, count
+        return False
+
+
+class preview_ready:
+    def __init__(self, locator, index=0, previous_src=None):
+        """Condition of WebDriverWait, true once the preview image shows an http url different from previous_src.
+        The previews first show the thumbnail, as a data uri, and the full resolution url once it is known.
+
+        Args:
+            locator (str): css selector of the preview images
+            index (int): index of the preview image among the matching elements
+            previous_src (str): src of the previous preview
+        """
+        self.locator = locator
+        self.index = index
+        self.previous_src = previous_src
+
+    def __call__(self, driver):
+        try:
+            images = driver.find_elements_by_css_selector(self.locator)
+            if len(images) <= self.index:
+                return False
+            src = images[self.index].get_attribute("src")
+        except (NoSuchElementException, StaleElementReferenceException):
+            return False
+        if src and src.startswith("http") and src != self.previous_src:
+            return src
+        return False
+
+
+class Throttle:
+    def __init__(self, policy="none", min_delay=1.0, max_delay=3.0):
+        """Pacing of the browser actions, kept apart from the waits on the page content.
+        "none" acts as soon as the page is ready, "human" adds a random pause after each scroll, click and preview.
+
+        Args:
+            policy (str): "none" or "human"
+            min_delay (float): min seconds of a pause of the human policy
+            max_delay (float): max seconds of a pause of the human policy
+        """
+        assert policy in THROTTLE_POLICIES, f"throttle policy must be one of {THROTTLE_POLICIES}"
+        self.policy = policy
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def delay(self):
+        """Seconds to pause before the next action, 0 for no pause"""
+        if self.policy == "none":
+            return 0
+        return random.uniform(self.min_delay, self.max_delay)
@@ -0,0 +1,256 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+from path import Path
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.mpo', '.ppm', '.tif', '.tiff', '.gif', '.pgm', '.pbm'}
+
+
+def list_images(dataset_dir):
+    # recursive, the download script can shard a directory in sub directories
+    images = []
+    for root, _, files in os.walk(dataset_dir):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                images.append(os.path.join(root, name))
+    return sorted(images)
+
+
+def split_hardlinks(files):
+    """Splits the files into one name per inode and the other names of the same inodes.
+    The download script can save the images as hard links to a content store, names sharing an inode are exact duplicates.
+
+    Returns (names, {other name: first name of its inode}), the files that can not be read are kept in names
+    """
+    first_names = {}
+    names, links = [], {}
+    for path in files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            names.append(path)
+            continue
+        inode = (st.st_dev, st.st_ino)
+        if st.st_nlink > 1 and inode in first_names:
+            links[path] = first_names[inode]
+        else:
+            first_names[inode] = path
+            names.append(path)
+    return names, links
+
+
+def hashes_to_uint64(hashes):
+    return np.array([int(h, 16) for h in hashes], dtype=np.uint64)
+
+
+def uint64_to_hashes(values):
+    return [format(int(v), '016x') for v in values]
+
+
+class EncodingStore:
+    """Persistent encodings of the images, keyed by path, size and modification time.
+
+    The encodings are kept in append-only segments, so a run only writes the encodings of the images it encoded.
+    The store is a directory holding:
+      - meta.json: encoder type, generation and segments of the store, written last: it commits the run
+      - encodings_<segment>.npy: float32 matrix for CNN, uint64 vector of the 64 bit hashes for DHash
+      - stats_<segment>.npy: int64 (size, mtime_ns) of each image when it was encoded
+      - paths_<segment>.txt: one image path per line
+      - removed_<generation>.npy: bool mask of the rows of all the segments that are removed or outdated
+      - failed_<generation>.txt: path, size and mtime_ns of the images that could not be encoded, skipped until they change
+    Rows of the three files of a segment are aligned, the rows of the store are the rows of its segments in order.
+    The encodings are memory-mapped when loaded. The segments are merged into one when too many rows are removed
+    or there are too many segments. Stores written as single encodings.npy, stats.npy and paths.txt files are read
+    as a segment.
+    """
+    MAX_SEGMENTS = 16
+    # share of removed rows above which the segments are merged
+    MAX_REMOVED = 0.25
+
+    def __init__(self, store_dir, encoder_type):
+        self.store_dir = Path(store_dir)
+        self.encoder_type = encoder_type
+        self.generation = 0
+        self.segments = []
+        self.encodings = []
+        self.paths = []
+        self.stats = np.zeros((0, 2), dtype=np.int64)
+        self.removed = np.zeros(0, dtype=bool)
+        self.failed = {}
+        self.load()
+
+    def load(self):
+        meta_file = self.store_dir / 'meta.json'
+        if not meta_file.exists():
+            return
+        with open(meta_file) as fp:
+            meta = json.load(fp)
+        assert meta['encoder'] == self.encoder_type, \
+            f'{self.store_dir} holds {meta["encoder"]} encodings, not {self.encoder_type}'
+        # stores written before the segments: a single segment without suffix
+        self.generation = meta.get('generation', 0)
+        self.segments = meta.get('segments', [''])
+        stats = []
+        for segment in self.segments:
+            with open(self.store_dir / f'paths{segment}.txt') as fp:
+                self.paths.extend(fp.read().splitlines())
+            stats.append(np.load(self.store_dir / f'stats{segment}.npy').reshape(-1, 2))
+            self.encodings.append(np.load(self.store_dir / f'encodings{segment}.npy', mmap_mode='r'))
+        self.stats = np.concatenate([self.stats] + stats)
+        if 'segments' in meta:
+            self.removed = np.load(self.store_dir / f'removed_{self.generation:06d}.npy')
+            with open(self.store_dir / f'failed_{self.generation:06d}.txt') as fp:
+                for line in fp.read().splitlines():
+                    path, size, mtime = line.rsplit('\t', 2)
+                    self.failed[path] = (int(size), int(mtime))
+        else:
+            self.removed = np.zeros(len(self.paths), dtype=bool)
+        print(f'Loaded {len(self.paths) - int(self.removed.sum())} encodings from {self.store_dir}')
+
+    def save(self):
+        """Commits the segments, removed rows and failed images of a new generation, then deletes the files of the previous one"""
+        # every file is written aside and renamed, and meta.json is replaced last: an interrupted save leaves the previous store intact
+        self._write(f'removed_{self.generation:06d}.npy', lambda fp: np.save(fp, self.removed))
+        failed = ''.join(f'{path}\t{size}\t{mtime}\n' for path, (size, mtime) in self.failed.items())
+        self._write(f'failed_{self.generation:06d}.txt', lambda fp: fp.write(failed.encode('utf-8')))
+        meta = {'encoder': self.encoder_type, 'generation': self.generation, 'segments': self.segments}
+        self._write('meta.json', lambda fp: fp.write(json.dumps(meta).encode('utf-8')))
+        self._remove_unused_files()
+        print(f'Saved {len(self.paths) - int(self.removed.sum())} encodings to {self.store_dir}')
+
+    def _write(self, name, write):
+        os.makedirs(self.store_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=self.store_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            write(fp)
+        os.replace(tmp_file, self.store_dir / name)
+
+    def _remove_unused_files(self):
+        used = {'meta.json', f'removed_{self.generation:06d}.npy', f'failed_{self.generation:06d}.txt'}
+        for segment in self.segments:
+            used.update({f'encodings{segment}.npy', f'stats{segment}.npy', f'paths{segment}.txt'})
+        for name in os.listdir(self.store_dir):
+            if name not in used and os.path.splitext(name)[1] in ('.npy', '.txt', '.tmp'):
+                os.remove(self.store_dir / name)
+
+    def _add_segment(self, paths, stats, encodings):
+        segment = f'_{self.generation:06d}'
+        self._write(f'encodings{segment}.npy', lambda fp: np.save(fp, encodings))
+        self._write(f'stats{segment}.npy', lambda fp: np.save(fp, stats))
+        self._write(f'paths{segment}.txt', lambda fp: fp.write('\n'.join(paths).encode('utf-8')))
+        self.segments.append(segment)
+        self.encodings.append(np.load(self.store_dir / f'encodings{segment}.npy', mmap_mode='r'))
+        self.paths.extend(paths)
+        self.stats = np.concatenate([self.stats, stats])
+        self.removed = np.concatenate([self.removed, np.zeros(len(paths), dtype=bool)])
+
+    def _segment_rows(self, rows):
+        """Splits sorted store rows into (segment index, first row of the segment, local rows) of the segments holding them"""
+        start = 0
+        rows = np.asarray(rows, dtype=np.int64)
+        for i, encodings in enumerate(self.encodings):
+            end = start + len(encodings)
+            local = rows[(rows >= start) & (rows < end)] - start
+            if len(local):
+                yield i, start, local
+            start = end
+
+    def _compact(self):
+        """Merges the rows kept by all the segments into a single segment, copied segment by segment"""
+        rows = np.flatnonzero(~self.removed)
+        parts = list(self._segment_rows(rows))
+        segment = f'_{self.generation:06d}'
+        if parts:
+            first = self.encodings[parts[0][0]]
+            shape = (len(rows),) + first.shape[1:]
+            fd, tmp_file = tempfile.mkstemp(dir=self.store_dir, suffix='.tmp')
+            os.close(fd)
+            merged = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=first.dtype, shape=shape)
+            offset = 0
+            for i, _, local in parts:
+                merged[offset:offset + len(local)] = self.encodings[i][local]
+                offset += len(local)
+            merged.flush()
+            del merged
+            os.replace(tmp_file, self.store_dir / f'encodings{segment}.npy')
+        else:
+            self._write(f'encodings{segment}.npy', lambda fp: np.save(fp, self._to_array([])))
+        paths = [self.paths[row] for row in rows]
+        stats = self.stats[rows]
+        self._write(f'stats{segment}.npy', lambda fp: np.save(fp, stats))
+        self._write(f'paths{segment}.txt', lambda fp: fp.write('\n'.join(paths).encode('utf-8')))
+        self.segments = [segment]
+        self.encodings = [np.load(self.store_dir / f'encodings{segment}.npy', mmap_mode='r')]
+        self.paths = paths
+        self.stats = stats
+        self.removed = np.zeros(len(paths), dtype=bool)
+        print(f'Merged the encodings store into a single segment of {len(paths)} encodings')
+
+    def update(self, encode_files, dataset_dirs):
+        """Encodes the new and changed images of the directories, drops the removed ones and saves the store.
+        Only the new encodings are written, the previous segments are not read nor rewritten until they are merged.
+
+        encode_files is called with the list of paths to encode and returns {path: encoding}
+        """
+        images = []
+        for dataset_dir in dataset_dirs:
+            images.extend(list_images(dataset_dir))
+        current = {}
+        for image in images:
+            st = os.stat(image)
+            current[image] = (st.st_size, st.st_mtime_ns)
+
+        dataset_prefixes = tuple(os.path.join(d, '') for d in dataset_dirs)
+        removed = self.removed.copy()
+        known = set()
+        for row in np.flatnonzero(~removed):
+            path = self.paths[row]
+            if path in current:
+                if tuple(self.stats[row]) == current[path]:
+                    known.add(path)
+                else:
+                    removed[row] = True  # outdated, encoded again
+            elif path.startswith(dataset_prefixes):
+                removed[row] = True
+        # the images that could not be encoded are tried again once they change
+        failed = {path: stat for path, stat in self.failed.items()
+                  if current.get(path) == stat or (path not in current and not path.startswith(dataset_prefixes))}
+        to_encode = [image for image in images if image not in known and failed.get(image) != current[image]]
+        print(f'{len(known)} encodings up to date, {len(failed)} unreadable images skipped, {len(to_encode)} images to encode')
+        if not to_encode and np.array_equal(removed, self.removed) and failed == self.failed:
+            return
+
+        new_encodings = encode_files(to_encode) if to_encode else {}
+        encoded = [image for image in to_encode if new_encodings.get(image) is not None]
+        failed.update((image, current[image]) for image in to_encode if new_encodings.get(image) is None)
+        self.generation += 1
+        self.removed = removed
+        self.failed = failed
+        if encoded:
+            stats = np.array([current[image] for image in encoded], dtype=np.int64).reshape(-1, 2)
+            self._add_segment(encoded, stats, self._to_array([new_encodings[image] for image in encoded]))
+        if len(self.segments) > self.MAX_SEGMENTS or self.removed.sum() > self.MAX_REMOVED * len(self.removed):
+            self._compact()
+        self.save()
+
+    def _to_array(self, encodings):
+        if self.encoder_type == 'DHash':
+            return hashes_to_uint64(encodings)
+        if not encodings:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack(encodings).astype(np.float32)
+
+    def encoding_map(self, dataset_dirs):
+        """{path: encoding} of the images of the directories, in the format expected by imagededup"""
+        dataset_prefixes = tuple(os.path.join(d, '') for d in dataset_dirs)
+        rows = [row for row in np.flatnonzero(~self.removed) if self.paths[row].startswith(dataset_prefixes)]
+        encoding_map = {}
+        for i, start, local in self._segment_rows(rows):
+            if self.encoder_type == 'DHash':
+                values = uint64_to_hashes(self.encodings[i][local])
+            else:
+                values = np.asarray(self.encodings[i][local])
+            encoding_map.update(zip((self.paths[start + row] for row in local), values))
+        return encoding_map
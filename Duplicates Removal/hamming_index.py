@@ -0,0 +1,142 @@
+import math
+from itertools import combinations
+
+import numpy as np
+
+from similarity import remove_neighbors
+
+HASH_BITS = 64
+# chunks up to this width are looked up in a table of bucket offsets instead of a binary search
+DIRECT_TABLE_BITS = 22
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount64(values):
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):  # numpy >= 2.0
+        return np.bitwise_count(values)
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1)
+
+
+def choose_chunks(n, max_distance):
+    """Number of chunks minimizing the estimated query cost: probes per chunk times (lookup cost + expected bucket size)"""
+    best, best_cost = 1, None
+    for chunks in range(1, min(max_distance + 1, HASH_BITS) + 1):
+        width = HASH_BITS // chunks
+        radius = max_distance // chunks
+        probes = sum(math.comb(width, r) for r in range(radius + 1))
+        # a lookup, a random access in the chunk table, costs about as much as verifying 4 candidates
+        cost = chunks * probes * (4 + n / 2 ** width)
+        if best_cost is None or cost < best_cost:
+            best, best_cost = chunks, cost
+    return best
+
+
+def flip_masks(width, radius):
+    """All the values of `width` bits with at most `radius` bits set"""
+    masks = [0]
+    for r in range(1, radius + 1):
+        for bits in combinations(range(width), r):
+            masks.append(sum(1 << b for b in bits))
+    return np.array(masks, dtype=np.uint64)
+
+
+class HammingIndex:
+    """Multi-index hashing over packed 64 bit hashes.
+
+    Hashes are split in `chunks` substrings, each indexed in a sorted table. By the pigeonhole principle two
+    hashes within max_distance share at least one substring within max_distance // chunks, so a range query
+    only looks up the buckets of the substrings within that radius and verifies the candidates.
+    The number of chunks balances the number of probed substrings against the size of the buckets.
+    """
+
+    def __init__(self, hashes, max_distance, chunks=None):
+        self.hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+        self.max_distance = max_distance
+        n = len(self.hashes)
+        if chunks is None:
+            chunks = choose_chunks(n, max_distance)
+        self.chunks = chunks
+        widths = [HASH_BITS // chunks + (1 if c < HASH_BITS % chunks else 0) for c in range(chunks)]
+        self.shifts = np.cumsum([0] + widths[:-1]).tolist()
+        self.widths = widths
+        self.radius = max_distance // chunks
+        self.tables = []
+        for shift, width in zip(self.shifts, self.widths):
+            values = self.chunk_values(self.hashes, shift, width)
+            order = np.argsort(values, kind='stable')
+            sorted_values = values[order]
+            offsets = None
+            if width <= DIRECT_TABLE_BITS:
+                offsets = np.searchsorted(sorted_values, np.arange((1 << width) + 1, dtype=np.uint64))
+            self.tables.append((sorted_values, offsets, order, flip_masks(width, self.radius)))
+
+    @staticmethod
+    def chunk_values(hashes, shift, width):
+        return (hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+
+    @staticmethod
+    def buckets(sorted_values, offsets, targets):
+        """(start, count) in the sorted table of the chunk values equal to the targets"""
+        if offsets is not None:
+            targets = targets.astype(np.int64)
+            starts = offsets[targets]
+            return starts, offsets[targets + 1] - starts
+        starts = np.searchsorted(sorted_values, targets, side='left')
+        return starts, np.searchsorted(sorted_values, targets, side='right') - starts
+
+    def candidate_pairs(self, query_rows):
+        """(query row, indexed row) pairs sharing a substring within the radius, may contain repeated pairs"""
+        rows, cols = [], []
+        for (shift, width), (sorted_values, offsets, order, masks) in zip(zip(self.shifts, self.widths), self.tables):
+            values = self.chunk_values(self.hashes[query_rows], shift, width)
+            # every query value with every bit flip mask, in a single lookup
+            starts, counts = self.buckets(sorted_values, offsets, (values[:, np.newaxis] ^ masks).ravel())
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            # positions start, start + 1, ..., start + count - 1 of every probe, without a python loop
+            positions = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+            rows.append(np.repeat(np.repeat(query_rows, len(masks)), counts))
+            cols.append(order[positions])
+        if not rows:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        return np.concatenate(rows), np.concatenate(cols)
+
+    def pairs(self, candidates_per_batch=1 << 22):
+        """Yields (rows, cols) of all the pairs with cols > rows and distance <= max_distance, by batches of rows in ascending order"""
+        n = len(self.hashes)
+        # expected probes and candidates per query, bounds the size of the temporary arrays
+        per_query = self.chunks * len(self.tables[0][3]) * (1 + n / 2 ** min(self.widths))
+        batch_size = max(1, int(candidates_per_batch // per_query))
+        for a in range(0, n, batch_size):
+            rows, cols = self.candidate_pairs(np.arange(a, min(n, a + batch_size)))
+            upper = cols > rows
+            rows, cols = rows[upper], cols[upper]
+            close = popcount64(self.hashes[rows] ^ self.hashes[cols]) <= self.max_distance
+            # a pair close in several chunks is found several times
+            pairs = np.unique(rows[close] * n + cols[close])
+            yield pairs // n, pairs % n
+
+    def query(self, value):
+        """Rows of the indexed hashes within max_distance of value (range query)"""
+        value = np.array([value], dtype=np.uint64)
+        rows = []
+        for (shift, width), (sorted_values, offsets, order, masks) in zip(zip(self.shifts, self.widths), self.tables):
+            starts, counts = self.buckets(sorted_values, offsets, self.chunk_values(value, shift, width) ^ masks)
+            rows.extend(order[s:s + c] for s, c in zip(starts, counts) if c > 0)
+        if not rows:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.unique(np.concatenate(rows))
+        return rows[popcount64(self.hashes[rows] ^ value) <= self.max_distance]
+
+
+def dhash_duplicates_to_remove(paths, hashes, max_distance):
+    """Same result as imagededup Hashing.find_duplicates_to_remove(max_distance_threshold=max_distance)"""
+    index = HammingIndex(hashes, max_distance)
+    print(f'Hamming index: {index.chunks} chunks, radius {index.radius} per chunk')
+    to_remove = np.zeros(len(paths), dtype=bool)
+    for rows, cols in index.pairs():
+        remove_neighbors(to_remove, rows, cols)
+    return [paths[i] for i in np.flatnonzero(to_remove)]
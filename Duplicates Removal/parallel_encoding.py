@@ -0,0 +1,77 @@
+import os
+from collections import deque
+from functools import partial
+import multiprocessing
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+from imagededup.utils.image_utils import load_image
+
+# hash encoder of the worker process, created once per process by the pool initializer
+_hash_encoder = None
+
+
+def _init_hash_worker(encoder_class):
+    global _hash_encoder
+    _hash_encoder = encoder_class()
+
+
+def _hash_file(image_file):
+    return image_file, _hash_encoder.encode_image(image_file=image_file)
+
+
+def _load_cnn_input(image_file, target_size):
+    # same decoding and resizing as imagededup CNN.encode_image
+    return load_image(image_file=image_file, target_size=target_size, grayscale=False)
+
+
+def encode_hashes(encoder_class, files, workers=None, chunksize=64):
+    """Hashes the files on a process pool, {path: hash} of the readable files in the order of files.
+    The duplicates kept depend on the order of the encodings, it must not change with the number of workers.
+    """
+    encodings = {}
+    with Pool(workers, initializer=_init_hash_worker, initargs=(encoder_class,)) as pool, \
+            tqdm(total=len(files), desc='Encoding', unit='img') as progress:
+        for image_file, encoding in pool.imap(_hash_file, files, chunksize=chunksize):
+            if encoding is not None:
+                encodings[image_file] = encoding
+            progress.update()
+    return encodings
+
+
+def encode_cnn(encoder, files, workers=None, batch_size=64, prefetch=2):
+    """CNN features of the files, {path: features} of the readable files.
+
+    The images are decoded and resized by a process pool while the model runs on the previous batch,
+    at most `prefetch` batches are decoded ahead so the memory used does not grow with the number of files.
+    """
+    from tensorflow.keras.applications.mobilenet import preprocess_input
+
+    workers = workers or os.cpu_count()
+    chunksize = max(1, batch_size // workers)
+    load = partial(_load_cnn_input, target_size=encoder.target_size)
+    encodings = {}
+    # TensorFlow and the model are already running in this process, forking its thread pools can deadlock the workers.
+    # Spawned workers start from a fresh interpreter and only run the image loading of imagededup
+    with multiprocessing.get_context('spawn').Pool(workers) as pool, tqdm(total=len(files), desc='Encoding', unit='img') as progress:
+        pending = deque()
+        for i in range(0, len(files), batch_size):
+            batch = files[i:i + batch_size]
+            pending.append((batch, pool.map_async(load, batch, chunksize=chunksize)))
+            if len(pending) > prefetch:
+                progress.update(_predict_batch(encoder, preprocess_input, *pending.popleft(), encodings))
+        while pending:
+            progress.update(_predict_batch(encoder, preprocess_input, *pending.popleft(), encodings))
+    return encodings
+
+
+def _predict_batch(encoder, preprocess_input, batch, images, encodings):
+    loaded = [(image_file, image) for image_file, image in zip(batch, images.get()) if image is not None]
+    if not loaded:
+        return len(batch)
+    inputs = preprocess_input(np.stack([image for _, image in loaded]).astype(np.float32))
+    features = encoder.model.predict(inputs, batch_size=len(loaded))
+    for (image_file, _), feature in zip(loaded, features):
+        encodings[image_file] = feature
+    return len(batch)
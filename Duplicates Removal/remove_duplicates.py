@@ -5,6 +5,11 @@ import tensorflow as tf
 from path import Path
 from imagededup.methods import CNN, DHash
 
+from encoding_store import EncodingStore, hashes_to_uint64, list_images, split_hardlinks
+from hamming_index import dhash_duplicates_to_remove
+from parallel_encoding import encode_cnn, encode_hashes
+from similarity import encodings_to_matrix, cnn_duplicates_to_remove, cnn_duplicates_to_remove_ann
+
 
 encoder_methods = {
     'CNN' : CNN,
@@ -28,6 +33,18 @@ def get_args():
     parser.add_argument('--encodings_in', nargs='+', default=[], help='Input encodings path')
     parser.add_argument('--encodings_out', type=Path, default=None, help='Output encodings path')
     parser.add_argument('--encodings_only', action='store_true', help='Only compute encodings and finish')
+    parser.add_argument('--encodings_store', type=Path, default=None,
+        help='Encodings store directory, only new or modified images are encoded and the store is updated')
+    parser.add_argument('--similarity', type=str, choices=['native', 'imagededup'], default='native',
+        help='Duplicates search: native uses a Hamming index for DHash and computes CNN similarities by blocks within --memory_budget, '
+             'imagededup compares all pairs')
+    parser.add_argument('--memory_budget', type=int, default=1024, help='Memory budget in MB of a block of CNN similarities')
+    parser.add_argument('--ann', action='store_true', help='Approximate CNN similarity search with a faiss index, requires faiss')
+    parser.add_argument('--ann_nlist', type=int, default=1024, help='Number of inverted lists of the faiss index')
+    parser.add_argument('--ann_nprobe', type=int, default=16, help='Number of inverted lists visited per query')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+        help='Number of processes decoding the images (CNN) or hashing them (DHash)')
+    parser.add_argument('--batch_size', type=int, default=64, help='Number of images per CNN inference batch')
     args = parser.parse_args()
     return args
 
@@ -38,21 +55,38 @@ def tf_startup():
         tf.config.experimental.set_memory_growth(gpu, True)
 
 
-def encode_dataset(encoder, dataset_dir):
-    encodings = encoder.encode_images(dataset_dir)
-    encodings = {f'{dataset_dir}/{k}' : v for k, v in encodings.items()}
+def encode_files(args, encoder, files):
+    # hard links to the same content are encoded once
+    files, links = split_hardlinks(files)
+    if links:
+        print(f'{len(links)} images are hard links to other images, encoded once')
+    # hashes are computed by a process pool, CNN features by batches fed by a decoding process pool
+    if args.encoder == 'CNN':
+        encodings = encode_cnn(encoder, files, workers=args.workers, batch_size=args.batch_size)
+    else:
+        encodings = encode_hashes(type(encoder), files, workers=args.workers)
+    for link, original in links.items():
+        if original in encodings:
+            encodings[link] = encodings[original]
     return encodings
 
 
-def encode_datasets(encoder, dataset_root, dataset_dirs):
+def encode_datasets(args, encoder, dataset_root, dataset_dirs):
     all_encodings = {}
     for dataset in dataset_dirs:
         print(f'Encoding dataset {dataset}')
-        encodings = encode_dataset(encoder, dataset_root / dataset)
+        encodings = encode_files(args, encoder, list_images(dataset_root / dataset))
         all_encodings.update(encodings)
     return all_encodings
 
 
+def update_store(args, encoder, store_dir, dataset_root, dataset_dirs):
+    store = EncodingStore(store_dir, args.encoder)
+    dirs = [dataset_root / dataset for dataset in dataset_dirs]
+    store.update(lambda files: encode_files(args, encoder, files), dirs)
+    return store.encoding_map(dirs)
+
+
 def load_encodings(encodings_in):
     print('Loading encodings:')
     encodings = {}
@@ -60,8 +94,7 @@ def load_encodings(encodings_in):
         enc_file = Path(enc).with_suffix('.json')
         print(f'Loading {enc_file}')
         with open(enc_file, 'r') as fp:
-            data = json.load(fp)
-            encodings = {**encodings, **data}
+            encodings.update(json.load(fp))
     return encodings
 
 
@@ -69,8 +102,10 @@ def get_encodings(args, encoder):
     encodings = None
     if args.encodings_in != []:
         encodings = load_encodings(args.encodings_in)
+    elif args.encodings_store:
+        encodings = update_store(args, encoder, args.encodings_store, args.dirs_root, args.dirs)
     else:
-        encodings = encode_datasets(encoder, args.dataset_root, args.dataset_dirs)
+        encodings = encode_datasets(args, encoder, args.dirs_root, args.dirs)
     return encodings
 
 
@@ -84,6 +119,21 @@ def save_encodings(encodings, encodings_out, encoder_type):
         json.dump(encodings, fp)
 
 
+def get_cnn_duplicates(args, encodings):
+    paths, matrix = encodings_to_matrix(encodings)
+    print(f'Searching duplicates among {len(paths)} encodings')
+    if args.ann:
+        return cnn_duplicates_to_remove_ann(paths, matrix, args.threshold, nlist=args.ann_nlist, nprobe=args.ann_nprobe)
+    return cnn_duplicates_to_remove(paths, matrix, args.threshold, memory_budget_mb=args.memory_budget)
+
+
+def get_dhash_duplicates(args, encodings):
+    paths = list(encodings.keys())
+    hashes = hashes_to_uint64(encodings.values())
+    print(f'Searching duplicates among {len(paths)} hashes')
+    return dhash_duplicates_to_remove(paths, hashes, int(args.threshold))
+
+
 def get_duplicates(encoder, encodings, encoder_type, threshold):
     duplicates = None
     if encoder_type == 'CNN':
@@ -124,11 +174,24 @@ def process_duplicates(args):
     if args.encodings_only:
         return
 
-    duplicates = get_duplicates(encoder, encodings, args.encoder, args.threshold)
-    print(f'Number of duplicates to remove: {len(duplicates)}')
+    # names sharing an inode are exact duplicates, they are removed without comparing their encodings
+    unique, links = split_hardlinks(sorted(encodings))
+    if links:
+        print(f'{len(links)} exact duplicates are hard links to other images')
+        encodings = {path: encodings[path] for path in unique}
+
+    if args.encoder == 'CNN' and args.similarity == 'native':
+        duplicates = get_cnn_duplicates(args, encodings)
+    elif args.encoder == 'DHash' and args.similarity == 'native':
+        duplicates = get_dhash_duplicates(args, encodings)
+    else:
+        duplicates = get_duplicates(encoder, encodings, args.encoder, args.threshold)
 
     if args.display_duplicates:
-        display_duplicates(encoder, encodings, args.encoder_type, args.threshold, duplicates)
+        display_duplicates(encoder, encodings, args.encoder, args.threshold, duplicates)
+
+    duplicates = list(links) + list(duplicates)
+    print(f'Number of duplicates to remove: {len(duplicates)}')
 
     if not args.dry_run:
         move_duplicates(duplicates, args.duplicates_dir)
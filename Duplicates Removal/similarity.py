@@ -0,0 +1,95 @@
+import math
+
+import numpy as np
+
+
+def encodings_to_matrix(encodings):
+    """Paths and float32 matrix of a {path: encoding} map"""
+    paths = list(encodings.keys())
+    values = list(encodings.values())
+    base = values[0].base if values and isinstance(values[0], np.ndarray) else None
+    # the encodings store hands out rows of a single matrix, reuse it instead of copying every row
+    if base is not None and base.ndim == 2 and len(base) == len(values) and all(v.base is base for v in values):
+        return paths, base.astype(np.float32, copy=False)
+    return paths, np.asarray(values, dtype=np.float32)
+
+
+def remove_neighbors(to_remove, rows, cols):
+    """Greedy selection of imagededup's get_files_to_remove, on (row, col) pairs with col > row.
+
+    Files are visited in order, a file not already removed removes all its duplicates. A duplicate
+    with a lower index than a kept file was necessarily removed before (it would otherwise have removed
+    the kept file), so only the pairs with col > row matter.
+    Pairs must be given for all the columns of the rows, rows in ascending order across calls.
+    """
+    if len(rows) == 0:
+        return
+    order = np.argsort(rows, kind='stable')
+    rows, cols = rows[order], cols[order]
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    ends = np.r_[starts[1:], len(rows)]
+    for start, end in zip(starts, ends):
+        if not to_remove[rows[start]]:
+            to_remove[cols[start:end]] = True
+
+
+def tile_size(memory_budget_mb, n):
+    # a square tile of float32 similarities fits in the memory budget
+    return max(1, min(n, int(math.sqrt(memory_budget_mb * 1024 * 1024 / 4))))
+
+
+def cnn_duplicates_to_remove(paths, matrix, threshold, memory_budget_mb=1024):
+    """Same result as imagededup CNN.find_duplicates_to_remove(min_similarity_threshold=threshold),
+    computed on tiles of the cosine similarity matrix instead of the full N x N matrix.
+    Only the upper triangle is computed.
+    """
+    n = len(paths)
+    norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+    norms[norms == 0] = 1
+    tile = tile_size(memory_budget_mb, n)
+    to_remove = np.zeros(n, dtype=bool)
+    for a in range(0, n, tile):
+        block = np.asarray(matrix[a:a + tile], dtype=np.float32) / norms[a:a + tile, np.newaxis]
+        rows, cols = [], []
+        for b in range(a, n, tile):
+            other = np.asarray(matrix[b:b + tile], dtype=np.float32) / norms[b:b + tile, np.newaxis]
+            scores = block @ other.T
+            i, j = np.nonzero(scores >= threshold)
+            i, j = i + a, j + b
+            upper = j > i
+            rows.append(i[upper])
+            cols.append(j[upper])
+        remove_neighbors(to_remove, np.concatenate(rows), np.concatenate(cols))
+    return [paths[i] for i in np.flatnonzero(to_remove)]
+
+
+def cnn_duplicates_to_remove_ann(paths, matrix, threshold, nlist=1024, nprobe=16, batch_size=65536):
+    """Approximate version of cnn_duplicates_to_remove on a faiss inverted file index, for very large corpora.
+    Duplicates falling in inverted lists that are not probed are missed.
+    """
+    import faiss  # optional dependency, only needed for the approximate search
+
+    n, dim = matrix.shape
+    quantizer = faiss.IndexFlatIP(dim)
+    index = faiss.IndexIVFFlat(quantizer, dim, min(nlist, n), faiss.METRIC_INNER_PRODUCT)
+
+    def normalized(a, b):
+        vectors = np.array(matrix[a:b], dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    sample = np.random.default_rng(0).choice(n, size=min(n, 256 * nlist), replace=False)
+    training = np.array(matrix[np.sort(sample)], dtype=np.float32)
+    faiss.normalize_L2(training)
+    index.train(training)
+    for a in range(0, n, batch_size):
+        index.add(normalized(a, a + batch_size))
+    index.nprobe = nprobe
+
+    to_remove = np.zeros(n, dtype=bool)
+    for a in range(0, n, batch_size):
+        lims, scores, ids = index.range_search(normalized(a, a + batch_size), threshold)
+        rows = np.repeat(np.arange(a, a + len(lims) - 1), np.diff(lims))
+        keep = (ids > rows) & (scores >= threshold)
+        remove_neighbors(to_remove, rows[keep], ids[keep])
+    return [paths[i] for i in np.flatnonzero(to_remove)]
@@ -1,22 +1,66 @@
+import argparse
+import os
+from functools import partial
+from multiprocessing import Pool
+
 import numpy as np
 import cv2
 
-p=open("path.txt") #file to all image paths
-o=open("isolated.txt",'w') #file to write to the isolated images' paths
-isolated=[]
-for im in p:
-    I=cv2.imread(im.rstrip())
-    c=0
-    w=0
-    for i in I:
-        for j in i:
-            c+=1
-            if (255 - np.mean(list(j))) <= 10:
-                w+=1
-    t=float(w)/float(c) *100
-    if t>=30:
-        isolated.append(im)
-
-for i in isolated:
-    o.write(i)
 
+def get_args():
+    parser = argparse.ArgumentParser('Isolated images filter', description='Find the images with a white background')
+    parser.add_argument('--paths', type=str, default='path.txt', help='File with line separated image paths')
+    parser.add_argument('--output', type=str, default='isolated.txt', help='File to write the isolated images paths to')
+    parser.add_argument('--tolerance', type=float, default=10,
+        help='A pixel is white when 255 minus the mean of its channels is at most tolerance')
+    parser.add_argument('--ratio', type=float, default=30, help='Min percentage of white pixels for an image to be isolated')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes reading the images')
+    parser.add_argument('--chunksize', type=int, default=16, help='Number of paths sent to a process at once')
+    args = parser.parse_args()
+    return args
+
+
+def white_ratio(image, tolerance):
+    # 255 - mean(pixel) <= tolerance  <=>  sum(pixel) >= channels * (255 - tolerance), no float copy of the image needed
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+    channels = image.shape[2]
+    sums = image.sum(axis=2, dtype=np.uint16)
+    white = np.count_nonzero(sums >= channels * (255 - tolerance))
+    return float(white) / float(sums.size) * 100
+
+
+def check_image(path, tolerance, ratio):
+    image = cv2.imread(path)
+    if image is None:  # corrupt or missing file
+        return path, None
+    return path, white_ratio(image, tolerance) >= ratio
+
+
+def read_paths(paths_file):
+    with open(paths_file) as p:
+        for line in p:
+            path = line.rstrip()
+            if path:
+                yield path
+
+
+def main():
+    args = get_args()
+    check = partial(check_image, tolerance=args.tolerance, ratio=args.ratio)
+    count, isolated, unreadable = 0, 0, 0
+    with Pool(args.workers, initializer=cv2.setNumThreads, initargs=(1,)) as pool, open(args.output, 'w') as o:
+        for path, is_isolated in pool.imap_unordered(check, read_paths(args.paths), chunksize=args.chunksize):
+            count += 1
+            if is_isolated is None:
+                unreadable += 1
+                print(f'Could not read image {path}, skipping')
+            elif is_isolated:
+                isolated += 1
+                o.write(path + '\n')
+                o.flush()
+    print(f'{isolated} isolated images out of {count}, {unreadable} unreadable')
+
+
+if __name__ == '__main__':
+    main()
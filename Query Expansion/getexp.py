@@ -1,39 +1,202 @@
+import argparse
+import hashlib
+import json
+import os
 import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus
 
+import requests
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.support.wait import WebDriverWait
 
 URL = "http://mykeyworder.com/keywords?tags="
-expansions = []
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4422.0 Safari/537.36"
+KEYWORD_INPUT = "<input checked=\"\" name=\"keywordselect[]\" onclick=\"countCheckboxes()\" type=\"checkbox\" value=\""
 
 
-def get_exp(query):
-    keys = open('Keys.txt', 'a')
-    browser_options = Options()
-    browser_options.add_argument("--headless")
-    driver = webdriver.Firefox(options=browser_options)
-    driver.implicitly_wait(10)
-    base_url = str(URL + str(sys.argv[1]))
-    driver.get(base_url)
+def parse_keywords(page_source):
+    """Keywords listed on a mykeyworder result page, in the page order"""
+    bs = BeautifulSoup(page_source, features="html.parser")
+    columns = bs.findAll("div", {"class": "col-md-2"})
+    if len(columns) < 2:
+        return []
+    keywords = []
+    for x in str(columns[1]).split("\n"):
+        if KEYWORD_INPUT in x:
+            keywords.append(x.split(KEYWORD_INPUT)[1].split("\"/>")[0])
+    return keywords
+
+
+def log(message):
+    # stdout holds the expansions of a single query
+    print(message, file=sys.stderr, flush=True)
+
+
+def expand(query, keywords):
+    return [query + " " + keyword for keyword in keywords if keyword not in query]
+
+
+class KeywordCache:
+    def __init__(self, cache_dir, ttl):
+        """Keywords of the queries already expanded, one json file per query, entries older than ttl seconds are ignored"""
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, query):
+        return os.path.join(self.cache_dir, hashlib.sha1(query.lower().encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, query):
+        try:
+            with open(self.path(query)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("query") != query or time.time() - entry.get("time", 0) > self.ttl:
+            return None
+        return entry["keywords"]
+
+    def put(self, query, keywords):
+        # written aside and renamed, concurrent workers never read a partial entry
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"query": query, "keywords": keywords, "time": time.time()}, f)
+        os.replace(tmp_file, self.path(query))
+
+
+class Expander:
+    def __init__(self, fetch="auto", cache=None, timeout=10):
+        """Fetches the keywords of the queries, with a plain http request or a headless Firefox.
+        Each worker thread starts its browser on first use and keeps it for all its queries.
+
+        fetch: "http", "browser" or "auto" (http first, the browser when the page has no keywords)
+        """
+        self.fetch = fetch
+        self.cache = cache
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": USER_AGENT})
+        self.local = threading.local()
+        self.drivers = []
+        self.drivers_lock = threading.Lock()
+
+    def get_driver(self):
+        if getattr(self.local, "driver", None) is None:
+            browser_options = Options()
+            browser_options.add_argument("--headless")
+            self.local.driver = webdriver.Firefox(options=browser_options)
+            with self.drivers_lock:
+                self.drivers.append(self.local.driver)
+        return self.local.driver
+
+    def fetch_http(self, query):
+        response = self.session.get(URL + quote_plus(query), timeout=self.timeout)
+        response.raise_for_status()
+        return parse_keywords(response.text)
+
+    def fetch_browser(self, query):
+        driver = self.get_driver()
+        driver.get(URL + query)
+        # the keywords column is rendered by the page, wait for it instead of sleeping a fixed time
+        try:
+            WebDriverWait(driver, self.timeout).until(lambda d: len(d.find_elements_by_css_selector("div.col-md-2")) > 1)
+        except Exception:
+            pass
+        return parse_keywords(driver.page_source)
+
+    def keywords(self, query):
+        """Keywords of the query, from the cache when fresh. None when the page could not be fetched"""
+        if self.cache is not None:
+            keywords = self.cache.get(query)
+            if keywords is not None:
+                log(f"cached: {query}")
+                return keywords
+        log(f"started expanding : {query}")
+        keywords = None
+        try:
+            if self.fetch in ("http", "auto"):
+                try:
+                    keywords = self.fetch_http(query)
+                except Exception as e:
+                    if self.fetch == "http":
+                        raise
+                    log(f"http fetch failed for {query}, using the browser: {e}")
+            if self.fetch == "browser" or (self.fetch == "auto" and not keywords):
+                keywords = self.fetch_browser(query)
+        except Exception as e:
+            log(f"exception while expanding {query}: {e}")
+            return None
+        # no keywords comes from a blocked or unrendered page, not cached so the query is fetched again on the next run
+        if self.cache is not None and keywords:
+            self.cache.put(query, keywords)
+        return keywords
+
+    def close(self):
+        for driver in self.drivers:
+            driver.quit()
+        self.session.close()
+
+
+def expand_file(expander, queries_file, output_file, keys_file, workers):
+    """Expands every line of queries_file and appends one line of comma separated expansions per query to output_file"""
+    with open(queries_file) as f:
+        # blank lines are kept, the output lines must stay aligned with the directories file
+        queries = [line.rstrip() for line in f.read().splitlines()]
+    unique = [query for query in dict.fromkeys(queries) if query]
+    keywords = {"": []}
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(output_file, "a") as output, open(keys_file, "a") as keys:
+        results = zip(unique, executor.map(expander.keywords, unique))
+        # lines are written in the order of the queries file as soon as their expansion is known
+        for query in queries:
+            while query not in keywords:
+                done, found = next(results)
+                keywords[done] = found or []
+            expansions = expand(query, keywords[query])
+            output.write(", ".join(expansions) + "\n")
+            output.flush()
+            keys.write("".join(keyword + " " for keyword in keywords[query] if keyword not in query) + "\n")
+    log(f"{len(queries)} queries expanded to {output_file}")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Expands queries with the keywords of mykeyworder.com")
+    parser.add_argument("query", nargs="?", help="single query, its expansions are printed")
+    parser.add_argument("--queries", type=str, default=None, help="file with one query per line, expanded in a single run")
+    parser.add_argument("--output", type=str, default="expanded_queries.txt", help="file the expansions of --queries are appended to")
+    parser.add_argument("--keys", type=str, default="Keys.txt", help="file the keywords are appended to")
+    parser.add_argument("--workers", type=int, default=4, help="number of queries expanded concurrently, one browser per worker")
+    parser.add_argument("--fetch", type=str, default="auto", choices=["auto", "http", "browser"],
+                        help="plain http request, headless Firefox, or http with a fallback to Firefox")
+    parser.add_argument("--cache_dir", type=str, default=".expansion_cache", help="directory of the cached keywords")
+    parser.add_argument("--cache_ttl", type=float, default=30, help="days the cached keywords are reused, 0 disables the cache")
+    args = parser.parse_args()
+    if (args.query is None) == (args.queries is None):
+        parser.error("give either a query or --queries")
+    return args
+
+
+def main():
+    args = get_args()
+    cache = KeywordCache(args.cache_dir, args.cache_ttl * 24 * 3600) if args.cache_ttl > 0 else None
+    expander = Expander(fetch=args.fetch, cache=cache)
     try:
-        time.sleep(1)
-        bs = BeautifulSoup(driver.page_source, features="html.parser")
-        exp = str(bs.findAll("div", {"class": "col-md-2"})[1]).split("\n")
-        for x in exp:
-            try:
-                ss = str(x.split("<input checked=\"\" name=\"keywordselect[]\" onclick=\"countCheckboxes()\" type=\"checkbox\" value=\"")[1]).split("\"/>")[0]
-                if ss not in query:
-                    expansions.append(query + " " + ss)
-                    keys.write(ss + ' ')
-            except Exception as e:
-                continue
-        keys.write("\n")
-    except Exception as e:
-        print(f"exception while parsing html: {e}")
-    driver.close()
-
-
-get_exp(str(sys.argv[1]).rstrip())
-print(', '.join(expansions))
+        if args.queries is not None:
+            expand_file(expander, args.queries, args.output, args.keys, args.workers)
+        else:
+            query = args.query.rstrip()
+            keywords = expander.keywords(query) or []
+            with open(args.keys, "a") as keys:
+                keys.write("".join(keyword + " " for keyword in keywords if keyword not in query) + "\n")
+            print(", ".join(expand(query, keywords)))
+    finally:
+        expander.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import ast
+import json
+import logging
+import os
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_engine import FakeEngineServer, config_args, get_config
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def directory_size(directory):
+    """(number of images, total bytes) of the jpg files under directory"""
+    count, size = 0, 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(".jpg"):
+                count += 1
+                size += os.path.getsize(os.path.join(root, name))
+    return count, size
+
+
+def bench_downloader(args, server, work_dir):
+    """Downloads the results of fake queries with ImageScraper.download_images, no browser involved"""
+    from Download.downloader import ImageDownloader
+    from Download.image_scraper import ImageScraper, USER_AGENT
+    from Download.url_index import UrlIndex
+
+    class BenchScraper(ImageScraper):
+        def __init__(self, *args, **kwargs):
+            self.search_engine = "bench"
+            super().__init__(*args, **kwargs)
+
+    downloader = ImageDownloader(user_agent=USER_AGENT, workers=args.download_workers, connections_per_host=args.connections_per_host,
+                                 timeout=args.timeout, retries=args.retries, queue_size=args.download_queue_size)
+    url_index = UrlIndex(os.path.join(work_dir, "url_index.sqlite"))
+    image_dir = os.path.join(work_dir, "images")
+    urls = [url for i in range(args.queries) for url in server.image_urls(f"query {i}", "bench")]
+    start = time.perf_counter()
+    stats = {}
+    for i in range(args.queries):
+        scraper = BenchScraper(query=f"query {i}", save_img_dir=image_dir, index=i, num_of_images=args.results, run_headless=True,
+                               downloader=downloader, url_index=url_index)
+        scraper.images = server.image_urls(f"query {i}", "bench")
+        for key, value in scraper.download_images().items():
+            stats[key] = stats.get(key, 0) + value
+    elapsed = time.perf_counter() - start
+    downloader.close()
+    url_index.close()
+    images, size = directory_size(image_dir)
+    return {"urls": len(urls), "images": images, "bytes": size, "seconds": elapsed, "peak_rss_mb": peak_rss_mb(), "stats": stats}
+
+
+def bench_scrape(args, server, work_dir):
+    """Runs download.py against the fake search engines, requires firefox and geckodriver"""
+    queries_file = os.path.join(work_dir, "queries.txt")
+    dirnames_file = os.path.join(work_dir, "dirnames.txt")
+    image_dir = os.path.join(work_dir, "images")
+    with open(queries_file, "w") as f:
+        f.write("\n".join(",".join(f"query {line} {i}" for i in range(args.variants)) for line in range(args.queries)))
+    with open(dirnames_file, "w") as f:
+        f.write("\n".join(image_dir for _ in range(args.queries)))
+    command = [sys.executable, os.path.join(REPO_DIR, "download.py"), "--search_engine", args.search_engine, "--queries", queries_file,
+               "--directories", dirnames_file, "--num_of_images", str(args.results), "--run_headless", "--engine_url", server.url,
+               "--url_index", os.path.join(work_dir, "url_index.sqlite"), "--workers", str(args.workers),
+               "--download_workers", str(args.download_workers), "--connections_per_host", str(args.connections_per_host),
+               "--timeout", str(args.timeout), "--retries", str(args.retries)] + shlex.split(args.download_args)
+    logging.info(" ".join(command))
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=work_dir, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        sys.stderr.write(process.stderr)
+        raise RuntimeError(f"download.py exited with status {process.returncode}")
+    # the last line of the summary logged by the scheduler holds the counts of all the engines
+    totals = [line.split("total: ", 1)[1] for line in process.stderr.splitlines() if line.startswith("INFO: total: ")]
+    stats = ast.literal_eval(totals[-1]) if totals else {}
+    images, size = directory_size(image_dir)
+    return {"urls": stats.get("found", 0) + stats.get("known", 0), "images": images, "bytes": size, "seconds": elapsed,
+            "peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN), "stats": stats}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Download throughput against a local fake search engine and image server")
+    parser.add_argument("mode", choices=["downloader", "scrape"],
+                        help='downloader: ImageScraper.download_images on the result urls, scrape: download.py with firefox')
+    parser.add_argument("--queries", type=int, default=10, help='number of queries (lines of the queries file in scrape mode)')
+    parser.add_argument("--variants", type=int, default=1, help='scrape: number of queries per line')
+    parser.add_argument("--search_engine", type=str, default="all", choices=["all", "bing", "google", "yahoo"], help='scrape: search engine')
+    parser.add_argument("--workers", type=int, default=1, help='scrape: number of concurrent jobs')
+    parser.add_argument("--download_workers", type=int, default=8, help='number of concurrent image downloads')
+    parser.add_argument("--download_queue_size", type=int, default=100, help='max number of urls waiting for a download worker')
+    parser.add_argument("--connections_per_host", type=int, default=8, help='max number of concurrent downloads from the fake server')
+    parser.add_argument("--timeout", type=float, default=30, help='image download timeout')
+    parser.add_argument("--retries", type=int, default=3, help='image download retries')
+    parser.add_argument("--output", type=str, default=None, help='json lines file the result is appended to')
+    parser.add_argument("--min_images_per_s", type=float, default=None, help='exit with status 1 when the throughput is lower, for CI')
+    parser.add_argument("--keep", action="store_true", help='keep the downloaded images')
+    parser.add_argument("--download_args", type=str, default="", help='scrape: extra arguments of download.py, e.g. "--min_yield 0.2"')
+    config_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    server = FakeEngineServer(("127.0.0.1", 0), get_config(args))
+    server.start()
+    work_dir = tempfile.mkdtemp(prefix="bench_download_")
+    try:
+        result = (bench_downloader if args.mode == "downloader" else bench_scrape)(args, server, work_dir)
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    seconds = result["seconds"]
+    result.update({
+        "mode": args.mode,
+        "urls_per_s": result["urls"] / seconds,
+        "images_per_s": result["images"] / seconds,
+        "bytes_per_s": result["bytes"] / seconds,
+        "server": server.counts,
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "keep", "min_images_per_s")},
+        "time": time.time(),
+    })
+    logging.info(f"{args.mode}: {result['urls']} urls, {result['images']} images, {result['bytes'] / 1024 / 1024:.1f} MB in {seconds:.1f}s")
+    logging.info(f"{result['urls_per_s']:.1f} urls/s, {result['images_per_s']:.1f} images/s, "
+                 f"{result['bytes_per_s'] / 1024 / 1024:.2f} MB/s, peak RSS {result['peak_rss_mb']:.0f} MB")
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+    if args.min_images_per_s is not None and result["images_per_s"] < args.min_images_per_s:
+        logging.error(f"throughput {result['images_per_s']:.1f} images/s below {args.min_images_per_s}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import cv2
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the tools are scripts importing their modules from their own directory
+sys.path.insert(0, os.path.join(REPO_DIR, "Isolated Images Filter"))
+sys.path.insert(0, os.path.join(REPO_DIR, "Duplicates Removal"))
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+KINDS = ("original", "white", "duplicate", "near_duplicate")
+THRESHOLDS = {"DHash": 10, "CNN": 0.9}
+
+
+class StageSkipped(Exception):
+    """Raised by a stage that can not run, e.g. its input was not produced"""
+
+
+class Corpus:
+    def __init__(self, corpus_dir, resolution=(256, 256), duplicate_rate=0.1, near_duplicate_rate=0.1, white_rate=0.2, seed=0):
+        """Synthetic image corpus with planted exact duplicates, near duplicates and white background images.
+        Image i only depends on the seed and on the images before it, so a corpus of n images is the prefix of any larger
+        corpus with the same parameters and is generated once in a directory named after the parameters.
+
+        Args:
+            corpus_dir (str): parent directory of the corpora
+            resolution (tuple): (width, height) of the original images
+            duplicate_rate (float): share of the images that are byte for byte copies of an earlier image
+            near_duplicate_rate (float): share of the images that are resized, cropped and re-encoded copies of an earlier image
+            white_rate (float): share of the original images drawn on a white background
+            seed (int): seed of the corpus
+        """
+        self.resolution = tuple(resolution)
+        self.duplicate_rate = duplicate_rate
+        self.near_duplicate_rate = near_duplicate_rate
+        self.white_rate = white_rate
+        self.seed = seed
+        params = json.dumps(self.params(), sort_keys=True)
+        self.directory = os.path.join(corpus_dir, "corpus_" + hashlib.sha1(params.encode("utf-8")).hexdigest()[:10])
+        os.makedirs(os.path.join(self.directory, "images"), exist_ok=True)
+        with open(os.path.join(self.directory, "params.json"), "w") as f:
+            f.write(params)
+
+    def params(self):
+        return {"resolution": self.resolution, "duplicate_rate": self.duplicate_rate, "near_duplicate_rate": self.near_duplicate_rate,
+                "white_rate": self.white_rate, "seed": self.seed}
+
+    def path(self, i):
+        # sub directories of 10k images, as with the --shard_size of download.py
+        return os.path.join(self.directory, "images", str(i // 10000).zfill(4), f"{i:07d}.jpg")
+
+    def source(self, i):
+        """(kind, index of the copied image) of image i"""
+        rng = np.random.default_rng([self.seed, i])
+        r = rng.random()
+        if i > 0 and r < self.duplicate_rate:
+            return "duplicate", int(rng.integers(0, i))
+        if i > 0 and r < self.duplicate_rate + self.near_duplicate_rate:
+            return "near_duplicate", int(rng.integers(0, i))
+        return ("white" if rng.random() < self.white_rate else "original"), i
+
+    def render(self, i):
+        kind, j = self.source(i)
+        if kind == "duplicate":
+            return self.render(j)
+        rng = np.random.default_rng([self.seed, i, 1])
+        if kind == "near_duplicate":
+            return near_duplicate(self.render(j), rng)
+        return original(self.resolution, rng, white=kind == "white")
+
+    def write(self, i):
+        os.makedirs(os.path.dirname(self.path(i)), exist_ok=True)
+        cv2.imwrite(self.path(i), self.render(i), [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+    def generate(self, size, workers=None):
+        """Writes the images missing from the first size images, returns their paths"""
+        missing = [i for i in range(size) if not os.path.isfile(self.path(i))]
+        if missing:
+            logging.info(f"Generating {len(missing)} images in {self.directory}")
+            start = time.perf_counter()
+            with Pool(workers, initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+                for _ in pool.imap_unordered(self.write, missing, chunksize=64):
+                    pass
+            logging.info(f"Generated {len(missing)} images in {time.perf_counter() - start:.1f}s")
+        return [self.path(i) for i in range(size)]
+
+    def planted(self, size):
+        """Number of images of each kind among the first size images"""
+        counts = dict.fromkeys(KINDS, 0)
+        for i in range(size):
+            counts[self.source(i)[0]] += 1
+        return counts
+
+
+def original(resolution, rng, white=False):
+    width, height = resolution
+    if white:
+        # an object made of a few shapes on a white background, well above the 30% of white pixels of the isolated filter.
+        # The background varies slightly, between 247 and 255, a flat background would give the same hash bits to all these images
+        background = rng.integers(247, 256, (6, 6, 1), dtype=np.uint8).repeat(3, axis=2)
+        image = cv2.resize(background, (width, height), interpolation=cv2.INTER_CUBIC)
+        for _ in range(int(rng.integers(2, 5))):
+            center = (int(rng.integers(width // 4, 3 * width // 4)), int(rng.integers(height // 4, 3 * height // 4)))
+            axes = (int(rng.integers(width // 16, width // 5)), int(rng.integers(height // 16, height // 5)))
+            cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360, [int(c) for c in rng.integers(0, 200, 3)], -1)
+        return image
+    # smooth random background with a few shapes, distinct enough for the hashes and the CNN
+    image = cv2.resize(rng.integers(0, 256, (6, 6, 3), dtype=np.uint8), (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(int(rng.integers(2, 6))):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        cv2.circle(image, (x, y), int(rng.integers(width // 20, width // 5)), [int(c) for c in rng.integers(0, 256, 3)], -1)
+    return image
+
+
+def near_duplicate(image, rng):
+    # a CDN style copy: cropped, resized, brightness shifted and re-encoded
+    height, width = image.shape[:2]
+    crop = rng.uniform(0, 0.05, 4)
+    image = image[int(crop[0] * height):height - int(crop[1] * height), int(crop[2] * width):width - int(crop[3] * width)]
+    scale = rng.uniform(0.5, 0.95)
+    image = cv2.resize(image, (max(1, int(image.shape[1] * scale)), max(1, int(image.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+    image = cv2.convertScaleAbs(image, alpha=1.0, beta=float(rng.uniform(-15, 15)))
+    _, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(60, 90))])
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux, the workers of the stage are children of the stage process
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def _stage_process(results, stage, args):
+    try:
+        start = time.perf_counter()
+        result = stage(*args) or {}
+        result.setdefault("seconds", time.perf_counter() - start)
+        result["peak_rss_mb"] = peak_rss_mb()
+    except (ImportError, StageSkipped) as e:  # optional dependency of the stage or missing input
+        result = {"skipped": str(e)}
+    except Exception as e:
+        result = {"error": repr(e)}
+    results.put(result)
+
+
+def run_stage(stage, *args):
+    """Runs the stage in a fresh process, so its peak memory is measured alone"""
+    results = multiprocessing.get_context("fork").Queue()
+    process = multiprocessing.get_context("fork").Process(target=_stage_process, args=(results, stage, args))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def stage_decode(files, sample):
+    # single process, measures the cost of decoding an image
+    files = files[:sample]
+    for path in files:
+        cv2.imread(path)
+    return {"images": len(files)}
+
+
+def stage_filter(files, workers):
+    from isolatedfilter import check_image
+
+    check = partial(check_image, tolerance=10, ratio=30)
+    isolated = 0
+    with Pool(workers, initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+        for _, is_isolated in pool.imap_unordered(check, files, chunksize=16):
+            isolated += bool(is_isolated)
+    return {"images": len(files), "isolated": isolated}
+
+
+def stage_encode(files, encoder_type, workers, batch_size, encodings_file):
+    from parallel_encoding import encode_cnn, encode_hashes
+
+    if encoder_type == "CNN":
+        from imagededup.methods import CNN
+        encodings = encode_cnn(CNN(), files, workers=workers, batch_size=batch_size)
+        matrix = np.stack([encodings[f] for f in files if f in encodings]).astype(np.float32)
+    else:
+        from imagededup.methods import DHash
+        from encoding_store import hashes_to_uint64
+        encodings = encode_hashes(DHash, files, workers=workers)
+        matrix = hashes_to_uint64([encodings[f] for f in files if f in encodings])
+    np.save(encodings_file, matrix)
+    with open(encodings_file + ".paths", "w") as f:
+        f.write("\n".join(f for f in files if f in encodings))
+    return {"images": len(files), "encoded": len(encodings)}
+
+
+def stage_similarity(encoder_type, encodings_file, memory_budget):
+    from hamming_index import dhash_duplicates_to_remove
+    from similarity import cnn_duplicates_to_remove
+
+    if not os.path.isfile(encodings_file):
+        raise StageSkipped(f"{encodings_file} not found, run the encode stage")
+    matrix = np.load(encodings_file, mmap_mode="r")
+    with open(encodings_file + ".paths") as f:
+        paths = f.read().splitlines()
+    if encoder_type == "CNN":
+        duplicates = cnn_duplicates_to_remove(paths, matrix, THRESHOLDS["CNN"], memory_budget_mb=memory_budget)
+    else:
+        duplicates = dhash_duplicates_to_remove(paths, np.asarray(matrix), THRESHOLDS["DHash"])
+    with open(encodings_file + ".duplicates", "w") as f:
+        f.write("\n".join(duplicates))
+    return {"images": len(paths), "duplicates": len(duplicates)}
+
+
+def stage_move(encodings_file, duplicates_dir):
+    # same moves as move_duplicates of remove_duplicates.py, the files are moved back afterwards to keep the corpus
+    if not os.path.isfile(encodings_file + ".duplicates"):
+        raise StageSkipped("no duplicates list, run the similarity stage")
+    with open(encodings_file + ".duplicates") as f:
+        duplicates = [path for path in f.read().splitlines() if path]
+    os.makedirs(duplicates_dir, exist_ok=True)
+    start = time.perf_counter()
+    for path in duplicates:
+        os.rename(path, os.path.join(duplicates_dir, os.path.basename(path)))
+    seconds = time.perf_counter() - start
+    for path in duplicates:
+        os.rename(os.path.join(duplicates_dir, os.path.basename(path)), path)
+    return {"images": len(duplicates), "seconds": seconds}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Scaling of the isolated images filter and of the duplicates removal on synthetic corpora")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help='corpus sizes, e.g. 1000 10000 100000 1000000')
+    parser.add_argument("--encoders", type=str, nargs="+", default=["DHash"], choices=["DHash", "CNN"], help='encoders benchmarked')
+    parser.add_argument("--stages", type=str, nargs="+", default=["decode", "filter", "encode", "similarity", "move"],
+                        choices=["decode", "filter", "encode", "similarity", "move"], help='stages benchmarked')
+    parser.add_argument("--corpus_dir", type=str, default="bench_corpus", help='directory the corpora are generated in and reused from')
+    parser.add_argument("--resolution", type=int, nargs=2, default=[256, 256], help='width and height of the original images')
+    parser.add_argument("--duplicate_rate", type=float, default=0.1, help='share of exact duplicates')
+    parser.add_argument("--near_duplicate_rate", type=float, default=0.1, help='share of near duplicates')
+    parser.add_argument("--white_rate", type=float, default=0.2, help='share of white background originals')
+    parser.add_argument("--seed", type=int, default=0, help='seed of the corpus')
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help='number of processes of the generation, filter and encoding')
+    parser.add_argument("--batch_size", type=int, default=64, help='CNN inference batch size')
+    parser.add_argument("--memory_budget", type=int, default=1024, help='memory budget in MB of a block of CNN similarities')
+    parser.add_argument("--decode_sample", type=int, default=10000, help='number of images of the single process decode stage')
+    parser.add_argument("--output", type=str, default="bench_processing.jsonl", help='json lines file the results are appended to')
+    parser.add_argument("--plot", type=str, default=None, help='image file of the scaling curves, requires matplotlib')
+    return parser.parse_args()
+
+
+def plot_curves(records, plot_file):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    curves = dict()
+    for record in records:
+        if "images_per_s" in record:
+            label = record["stage"] if record["encoder"] is None else f"{record['stage']} ({record['encoder']})"
+            curves.setdefault(label, []).append((record["size"], record["images_per_s"], record["peak_rss_mb"]))
+    figure, axes = plt.subplots(1, 2, figsize=(14, 5))
+    for label, points in sorted(curves.items()):
+        sizes, images_per_s, rss = zip(*sorted(points))
+        axes[0].plot(sizes, images_per_s, marker="o", label=label)
+        axes[1].plot(sizes, rss, marker="o", label=label)
+    for axis, ylabel in zip(axes, ("images per second", "peak RSS (MB)")):
+        axis.set_xscale("log")
+        axis.set_yscale("log")
+        axis.set_xlabel("images")
+        axis.set_ylabel(ylabel)
+        axis.legend()
+    figure.savefig(plot_file, bbox_inches="tight")
+    logging.info(f"Scaling curves saved to {plot_file}")
+
+
+def main():
+    args = get_args()
+    corpus = Corpus(args.corpus_dir, args.resolution, args.duplicate_rate, args.near_duplicate_rate, args.white_rate, args.seed)
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    records = list()
+    for size in sorted(args.sizes):
+        files = corpus.generate(size, args.workers)
+        planted = corpus.planted(size)
+        stages = list()
+        if "decode" in args.stages:
+            stages.append(("decode", None, stage_decode, (files, args.decode_sample)))
+        if "filter" in args.stages:
+            stages.append(("filter", None, stage_filter, (files, args.workers)))
+        for encoder_type in args.encoders:
+            encodings_file = os.path.join(corpus.directory, f"{encoder_type}_{size}.npy")
+            if "encode" in args.stages:
+                stages.append(("encode", encoder_type, stage_encode, (files, encoder_type, args.workers, args.batch_size, encodings_file)))
+            if "similarity" in args.stages:
+                stages.append(("similarity", encoder_type, stage_similarity, (encoder_type, encodings_file, args.memory_budget)))
+            if "move" in args.stages:
+                stages.append(("move", encoder_type, stage_move, (encodings_file, os.path.join(corpus.directory, "duplicates"))))
+        for name, encoder_type, stage, stage_args in stages:
+            logging.info(f"{size} images: {name}" + (f" ({encoder_type})" if encoder_type else ""))
+            record = {"run": run_id, "size": size, "stage": name, "encoder": encoder_type, "planted": planted,
+                      "corpus": corpus.params(), "workers": args.workers}
+            record.update(run_stage(stage, *stage_args))
+            if "seconds" in record and record.get("images"):
+                record["images_per_s"] = record["images"] / record["seconds"]
+                logging.info(f"{record['seconds']:.2f}s, {record['images_per_s']:.1f} images/s, peak RSS {record['peak_rss_mb']:.0f} MB")
+            else:
+                logging.info(record.get("skipped") or record.get("error") or "done")
+            records.append(record)
+            # written as soon as measured, an interrupted run keeps the stages already done
+            with open(args.output, "a") as f:
+                f.write(json.dumps(record) + "\n")
+    logging.info(f"Results appended to {args.output}")
+    if args.plot:
+        plot_curves(records, args.plot)
+
+
+if __name__ == "__main__":
+    main()
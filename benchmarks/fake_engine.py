@@ -0,0 +1,247 @@
+import argparse
+import hashlib
+import html
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote_plus, urlsplit
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+# first bytes of the served images, the downloader checks the magic bytes of the responses
+JPEG_HEADER = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00"
+# results per page of the paged requests of the http harvest
+PAGE_SIZE = 35
+THUMBNAIL_STYLE = "display:inline-block;width:100px;height:100px;margin:2px;background:#ccc"
+
+BING_RESULTS = """<html><head><title>{query} - Bing images</title></head><body>
+<div class="dg_b">{thumbnails}</div>
+<iframe class="insightsOverlay" src="/bing/overlay?q={quoted_query}" style="width:600px;height:400px"></iframe>
+</body></html>"""
+
+# the next button is removed from the DOM after the last image, the scraper stops on the stale element
+BING_OVERLAY = """<html><body>
+<img class="nofocus" id="full" src="{first}" style="width:200px;height:200px">
+<div id="navr" style="width:50px;height:50px;background:#000" onclick="next()">next</div>
+<div class="close nofocus">x</div>
+<script>
+var urls = {urls};
+var i = 0;
+function next() {{
+    i++;
+    if (i >= urls.length) {{ document.getElementById("navr").remove(); return; }}
+    document.getElementById("full").src = urls[i];
+}}
+</script></body></html>"""
+
+GOOGLE_RESULTS = """<html><head><title>{query} - Google Search</title></head><body>
+<div class="T1diZc KWE8qe" style="margin-right:320px">{thumbnails}<div class="mye4qd" style="display:none">more</div></div>
+<div class="l39u4d" id="pane" style="display:none;position:fixed;right:0;top:0;width:300px">
+<img class="n3VNCb" style="width:50px;height:50px"><img class="n3VNCb" id="full" style="width:200px;height:200px"></div>
+<script>AF_initDataCallback({{key: "ds:1", data: {metadata}}});</script>
+<script>
+function show(thumbnail) {{
+    document.getElementById("full").src = thumbnail.dataset.full;
+    document.getElementById("pane").style.display = "block";
+}}
+</script></body></html>"""
+
+YAHOO_RESULTS = """<html><head><title>{query} - Yahoo Image Search Results</title></head><body>
+<section id="mdoc"><ul>{thumbnails}</ul><div class="ygbt more-res" style="display:none">more</div></section>
+</body></html>"""
+
+
+class FakeEngineConfig:
+    def __init__(self, results=100, overlap=0.0, image_size=100 * 1024, thumbnail_size=2 * 1024, latency=0.0, jitter=0.0,
+                 error_rate=0.0, error_status=404, seed=0):
+        """Behaviour of the fake search engines and image server
+
+        Args:
+            results (int): number of image results per query and engine
+            overlap (float): share of the results shared by all the queries and engines, to exercise the url deduplication
+            image_size (int): size in bytes of a served image
+            thumbnail_size (int): size in bytes of a served thumbnail, urls with a w parameter are thumbnails
+            latency (float): seconds waited before answering an image request
+            jitter (float): max random seconds added to the latency
+            error_rate (float): share of the image urls answered with error_status
+            error_status (int): status code of the failing image urls
+            seed (int): seed of the failing urls and of the jitter
+        """
+        self.results = results
+        self.overlap = overlap
+        self.image_size = image_size
+        self.thumbnail_size = thumbnail_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.seed = seed
+
+
+class FakeEngineServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        """Local http server answering the search pages of the scrapers and serving synthetic images.
+        The result pages match the css selectors of BingImageScraper, GoogleImageScraper and YahooImageScraper,
+        the search engines are told apart by the path of the url, as with --engine_url.
+
+        Args:
+            address (tuple): (host, port), port 0 picks a free port
+            config (FakeEngineConfig): behaviour of the server
+        """
+        super().__init__(address, FakeEngineHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.counts = {"pages": 0, "images": 0, "thumbnails": 0, "errors": 0, "bytes": 0}
+        self.padding = bytes(max(config.image_size, config.thumbnail_size))
+        self.random = random.Random(config.seed)
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.counts[key] += value
+
+    def image_urls(self, query, engine):
+        """Full size image urls of the results of a query on an engine"""
+        key = hashlib.sha1(f"{engine}/{query}".encode("utf-8")).hexdigest()[:12]
+        shared = int(self.config.results * self.config.overlap)
+        names = [f"shared_{i}" for i in range(shared)] + [f"{key}_{i}" for i in range(shared, self.config.results)]
+        return [f"{self.url}/img/{name}.jpg" for name in names]
+
+    def is_error(self, name):
+        return random.Random(f"{self.config.seed}/{name}").random() < self.config.error_rate
+
+    def start(self):
+        """Serves in a daemon thread, returns the thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, the downloader reuses its connections
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        query = params.get("q", [""])[0]
+        if url.path.startswith("/img/"):
+            self.send_image(url.path[len("/img/"):], thumbnail="w" in params)
+        elif url.path == "/images/search":
+            self.send_page(self.bing_results(query, params))
+        elif url.path == "/bing/overlay":
+            urls = self.server.image_urls(query, "bing")
+            self.send_page(BING_OVERLAY.format(first=html.escape(urls[0]) if urls else "", urls=json.dumps(urls)))
+        elif url.path == "/search":
+            self.send_page(self.google_results(query))
+        elif url.path == "/search/images":
+            self.send_page(self.yahoo_results(query, params))
+        else:
+            self.send_error(404)
+
+    def page(self, urls, params, start):
+        """Results of the page starting at the 1-based index of the start parameter, all the results without it"""
+        if start not in params:
+            return urls
+        first = max(int(params[start][0]) - 1, 0)
+        return urls[first:first + int(params.get("count", [PAGE_SIZE])[0])]
+
+    def bing_results(self, query, params):
+        # the link of each result holds its metadata as json, as read by the bulk extraction and the http harvest
+        thumbnails = "".join(f'<a class="iusc" m="{html.escape(json.dumps({"murl": url}))}"><img class="mimg" style="{THUMBNAIL_STYLE}"></a>'
+                             for url in self.page(self.server.image_urls(query, "bing"), params, "first"))
+        return BING_RESULTS.format(query=html.escape(query), quoted_query=html.escape(quote_plus(query)), thumbnails=thumbnails)
+
+    def google_results(self, query):
+        urls = self.server.image_urls(query, "google")
+        thumbnails = "".join(f'<img class="rg_i Q4LuWd" data-full="{html.escape(url)}" onclick="show(this)" style="{THUMBNAIL_STYLE}">'
+                             for url in urls)
+        # the inline script data lists the thumbnail then the full resolution image of each result, as [url, height, width]
+        metadata = [[[f"https://encrypted-tbn0.gstatic.com/images?q={i}", 100, 100], [url, 600, 800]] for i, url in enumerate(urls)]
+        # escaped like a script literal so no < or > closes the script element
+        metadata = json.dumps(metadata, separators=(",", ":")).replace("<", "\\u003c").replace(">", "\\u003e")
+        return GOOGLE_RESULTS.format(query=html.escape(query), thumbnails=thumbnails, metadata=metadata)
+
+    def yahoo_results(self, query, params):
+        # the scraper keeps the src up to the first &, the thumbnail parameters come after it
+        thumbnails = "".join(f'<li id="resitem-{i}"><a href="#"><img src="{html.escape(url)}?src=yahoo&amp;w=100" style="{THUMBNAIL_STYLE}"></a></li>'
+                             for i, url in enumerate(self.page(self.server.image_urls(query, "yahoo"), params, "b")))
+        return YAHOO_RESULTS.format(query=html.escape(query), thumbnails=thumbnails)
+
+    def send_page(self, page):
+        body = page.encode("utf-8")
+        self.server.count("pages")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_image(self, name, thumbnail):
+        config = self.server.config
+        if not thumbnail:
+            with self.server.lock:
+                jitter = self.server.random.uniform(0, config.jitter) if config.jitter else 0
+            if config.latency or jitter:
+                time.sleep(config.latency + jitter)
+            if self.server.is_error(name):
+                self.server.count("errors")
+                self.send_error(config.error_status)
+                return
+        # the name makes the content of every image unique
+        head = JPEG_HEADER + name.encode("utf-8")
+        size = max(len(head), config.thumbnail_size if thumbnail else config.image_size)
+        self.server.count("thumbnails" if thumbnail else "images")
+        self.server.count("bytes", size)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(head)
+        self.wfile.write(memoryview(self.server.padding)[:size - len(head)])
+
+
+def config_args(parser):
+    """Adds the FakeEngineConfig arguments to the parser"""
+    parser.add_argument("--results", type=int, default=100, help='number of image results per query and engine')
+    parser.add_argument("--overlap", type=float, default=0.0, help='share of the results shared by all the queries and engines')
+    parser.add_argument("--image_size", type=int, default=100 * 1024, help='size in bytes of the served images')
+    parser.add_argument("--latency", type=float, default=0.0, help='seconds waited before answering an image request')
+    parser.add_argument("--jitter", type=float, default=0.0, help='max random seconds added to the latency')
+    parser.add_argument("--error_rate", type=float, default=0.0, help='share of the image urls answered with --error_status')
+    parser.add_argument("--error_status", type=int, default=404, help='status code of the failing image urls')
+    parser.add_argument("--seed", type=int, default=0, help='seed of the failing urls and of the jitter')
+
+
+def get_config(args):
+    return FakeEngineConfig(results=args.results, overlap=args.overlap, image_size=args.image_size, latency=args.latency,
+                            jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake search engines and image server, for the benchmarks and manual runs of download.py")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    config_args(parser)
+    args = parser.parse_args()
+    server = FakeEngineServer((args.host, args.port), get_config(args))
+    logging.info(f"Serving on {server.url}, run download.py with --engine_url {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logging.info(f"Served {server.counts}")
+
+
+if __name__ == "__main__":
+    main()
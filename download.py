@@ -1,10 +1,20 @@
 import argparse
+import logging
 import os
 import sys
 import time
+from collections import Counter
 from itertools import zip_longest
 
-from Download.image_scraper import BingImageScraper, GoogleImageScraper, YahooImageScraper, open_file
+from Download.downloader import ImageDownloader
+from Download.driver_pool import WebDriverPool
+from Download.journal import Journal, DEFAULT_JOURNAL
+from Download.metrics import Metrics, profile
+from Download.object_store import ObjectStore
+from Download.scheduler import Job, Scheduler, YieldTracker
+from Download.url_index import UrlIndex, DEFAULT_URL_INDEX
+from Download.waits import Throttle, THROTTLE_POLICIES
+from Download.image_scraper import BingImageScraper, GoogleImageScraper, YahooImageScraper, open_file, EXTRACTION_MODES, HARVEST_MODES, USER_AGENT
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--search_engine", type=str, required=True, choices=["all", "bing", "google", "yahoo"], help='choose the search engine')
@@ -12,6 +22,47 @@ parser.add_argument("--queries", type=str, required=True, help='path to queries
 parser.add_argument("--directories", type=str, required=True, help='path to directories text file')
 parser.add_argument("--num_of_images", type=int, default=100, help='number of images to be scraped')
 parser.add_argument("--run_headless", action="store_true", help='run the script without launching firefox browser')
+parser.add_argument("--workers", type=int, default=1, help='number of (query, search engine) jobs running concurrently')
+parser.add_argument("--engine_concurrency", type=int, default=1, help='max number of jobs running concurrently on the same search engine')
+parser.add_argument("--engine_interval", type=float, default=0, help='min number of seconds between two jobs started on the same search engine')
+parser.add_argument("--driver_max_jobs", type=int, default=50, help='number of queries after which a firefox instance is restarted')
+parser.add_argument("--download_workers", type=int, default=8, help='number of concurrent image downloads')
+parser.add_argument("--download_queue_size", type=int, default=100, help='max number of harvested urls waiting for a download worker')
+parser.add_argument("--connections_per_host", type=int, default=4, help='max number of concurrent downloads from the same host')
+parser.add_argument("--timeout", type=float, default=30, help='connect and read timeout in seconds for image downloads')
+parser.add_argument("--retries", type=int, default=3, help='number of retries with backoff for failed image downloads')
+parser.add_argument("--url_index", type=str, default=DEFAULT_URL_INDEX, help='path to the index of downloaded urls shared by all directories')
+parser.add_argument("--global_url_dedup", action="store_true", help='skip urls already downloaded to any directory, not only the target one')
+parser.add_argument("--shard_size", type=int, default=None, help='save the images in sub directories holding at most this number of images')
+parser.add_argument("--quality_filter", action="store_true", help='decode the downloaded images and reject corrupt, small or (non) white background images')
+parser.add_argument("--min_width", type=int, default=0, help='quality filter: min width of the images in pixels')
+parser.add_argument("--min_height", type=int, default=0, help='quality filter: min height of the images in pixels')
+parser.add_argument("--white_background", type=str, default="any", choices=["any", "reject", "only"],
+                    help='quality filter: keep any image, reject the white background images or keep only them')
+parser.add_argument("--white_tolerance", type=float, default=10, help='quality filter: a pixel is white when 255 minus the mean of its channels is at most this value')
+parser.add_argument("--white_ratio", type=float, default=30, help='quality filter: min percentage of white pixels of a white background image')
+parser.add_argument("--near_duplicates", action="store_true", help='reject the images whose dHash is close to the hash of an image already in the directory')
+parser.add_argument("--near_duplicate_distance", type=int, default=10, help='near duplicates: max Hamming distance between the 64 bits hashes of two near duplicates')
+parser.add_argument("--min_yield", type=float, default=0, help='min share (0-1) of new urls, lower yield queries are stopped early and the next variants of the line skipped, 0 disables')
+parser.add_argument("--yield_window", type=int, default=50, help='number of last harvested urls the yield of a running query is measured on')
+parser.add_argument("--yield_patience", type=int, default=3, help='number of low yield queries in a row after which the rest of the line is low yield on that engine')
+parser.add_argument("--low_yield", type=str, default="stop", choices=["stop", "defer"], help='skip the low yield queries or run them after all the other queries')
+parser.add_argument("--engine_url", type=str, default=None, help='scheme and host replacing the search engines ones, e.g. the fake engine of the benchmarks')
+parser.add_argument("--max_image_size", type=float, default=20, help='max size of a downloaded image in MB, larger transfers are aborted')
+parser.add_argument("--metrics_dir", type=str, default=None, help='directory of the json lines event log and of the Prometheus metrics file of the run')
+parser.add_argument("--profile", type=str, default=None, help='profile the run with cProfile and write the stats of all the threads to this file')
+parser.add_argument("--wait_timeout", type=float, default=5, help='max seconds waited for more thumbnails after a scroll or for a preview to show its image')
+parser.add_argument("--throttle", type=str, default="none", choices=THROTTLE_POLICIES,
+                    help='none: act as soon as the page is ready, human: random pause after each scroll, click and preview')
+parser.add_argument("--throttle_delay", type=float, nargs=2, default=[1, 3], metavar=("MIN", "MAX"), help='min and max seconds of the human pauses')
+parser.add_argument("--extraction", type=str, default="auto", choices=EXTRACTION_MODES,
+                    help='bulk: read the urls of all the results with one script call, click: open each result, auto: click when the script finds no url')
+parser.add_argument("--harvest", type=str, default="auto", choices=HARVEST_MODES,
+                    help='http: page through the results without a browser, browser: firefox, auto: http when the engine allows it, firefox otherwise')
+parser.add_argument("--journal", type=str, default=DEFAULT_JOURNAL, help='path to the journal of the jobs and of their pending downloads')
+parser.add_argument("--resume", action="store_true", help='skip the jobs done by the previous run and download the urls it harvested but did not download')
+parser.add_argument("--cas_dir", type=str, default=None,
+                    help='content addressed store: each image content is stored once in this directory and the saved files are hard links to it')
 args = parser.parse_args()
 
 MAP_SCRAPER = {
@@ -21,26 +72,114 @@ MAP_SCRAPER = {
 }
 
 
+def get_jobs(args, queries, dirnames):
+    """Creates one job per query and search engine
+
+    Args:
+        args (argparse.Namespace): command line arguments
+        queries (list): lines of the queries file
+        dirnames (list): lines of the directories file
+
+    Returns:
+        list: list of Job
+    """
+    engines = list(MAP_SCRAPER.keys()) if args.search_engine == "all" else [args.search_engine]
+    jobs = list()
+    for line, (q_line, d_line) in enumerate(zip(queries, dirnames)):
+        queries_list = q_line.strip().split(',')
+        dirs_list = d_line.strip().split(',')
+        # if dirs_list contains only one directory, zip longest will replicate to match queries_list
+        for i, (query, directory) in enumerate(zip_longest(queries_list, dirs_list, fillvalue=dirs_list[0])):
+            for engine in engines:
+                jobs.append(Job(line=line, index=i, query=query.strip(), directory=directory.strip(), engine=engine))
+    return jobs
+
+
 def main(args):
     # Read the text files
     queries = open_file(args.queries)
     dirnames = open_file(args.directories)
+    event_file = None
+    if args.metrics_dir:
+        os.makedirs(args.metrics_dir, exist_ok=True)
+        event_file = os.path.join(args.metrics_dir, "events.jsonl")
+    metrics = Metrics(event_file)
+    # one download engine for the whole run so the connections are reused across queries and engines
+    downloader = ImageDownloader(user_agent=USER_AGENT, workers=args.download_workers, connections_per_host=args.connections_per_host,
+                                 timeout=args.timeout, retries=args.retries, max_bytes=int(args.max_image_size * 1024 * 1024), queue_size=args.download_queue_size,
+                                 metrics=metrics)
+    url_index = UrlIndex(args.url_index, global_scope=args.global_url_dedup)
+    # firefox is started once and reused by all the queries and engines, one browser per worker
+    driver_pool = WebDriverPool(USER_AGENT, size=args.workers, headless=args.run_headless, max_jobs=args.driver_max_jobs)
+    quality_filter = None
+    if args.quality_filter:
+        from Download.quality_filter import QualityFilter  # requires opencv and numpy
+        quality_filter = QualityFilter(min_width=args.min_width, min_height=args.min_height, white_background=args.white_background,
+                                       tolerance=args.white_tolerance, ratio=args.white_ratio)
+
+    throttle = Throttle(args.throttle, *args.throttle_delay)
+    object_store = ObjectStore(args.cas_dir) if args.cas_dir else None
+    journal = Journal(args.journal)
+    if not args.resume:
+        journal.reset()
+
+    def get_scraper(job):
+        return MAP_SCRAPER[job.engine](query=job.query, save_img_dir=job.directory, index=job.index, num_of_images=args.num_of_images,
+                                       run_headless=args.run_headless, downloader=downloader, url_index=url_index, shard_size=args.shard_size,
+                                       driver_pool=driver_pool, quality_filter=quality_filter,
+                                       near_duplicate_distance=args.near_duplicate_distance if args.near_duplicates else None,
+                                       min_yield=args.min_yield, yield_window=args.yield_window, engine_url=args.engine_url,
+                                       metrics=metrics, wait_timeout=args.wait_timeout, throttle=throttle,
+                                       extraction=args.extraction, harvest=args.harvest, journal=journal.job_journal(job),
+                                       object_store=object_store)
+
+    def run_job(job):
+        counts = Counter()
+        try:
+            # urls harvested by the previous run but not downloaded, no browser is needed for them
+            pending = journal.pending_urls(job) if args.resume else []
+            if pending:
+                logging.info(f"Resuming {len(pending)} pending downloads of {job.query} from {job.engine}")
+                scraper = get_scraper(job)
+                scraper.images = pending
+                counts.update(scraper.download_images())
+            # a job whose harvest completed only had downloads left
+            if journal.state(job) != "harvested":
+                logging.info(f"Downloading {job.query} from {job.engine}")
+                journal.set_state(job, "running")
+                counts.update(get_scraper(job).scrape())
+        except Exception as e:
+            journal.set_state(job, "failed", counts=dict(counts), error=str(e))
+            raise
+        journal.set_state(job, "done", counts=dict(counts))
+        return dict(counts)
 
     # start crawling the search engines
-    for q_line, d_line in zip(queries, dirnames):
-        queries_list = q_line.strip().split(',')
-        dirs_list = d_line.strip().split(',')
-        # if dirs_list contains only one directory, zip longest will replicate to match queries_list
-        for i, (query, directory) in enumerate(zip_longest(queries_list, dirs_list, fillvalue=dirs_list[0])):
-            directory = directory.strip()
-            query = query.strip()
-            print(f"Downloading {query}: ")
-            if args.search_engine == "all":
-                for engine in MAP_SCRAPER.keys():
-                    MAP_SCRAPER[engine](query=query, save_img_dir=directory, index=i, num_of_images=args.num_of_images, run_headless=args.run_headless).scrape()
-            else:
-                MAP_SCRAPER[args.search_engine](query=query, save_img_dir=directory, index=i, num_of_images=args.num_of_images, run_headless=args.run_headless).scrape()
+    yield_tracker = YieldTracker(min_yield=args.min_yield, patience=args.yield_patience)
+    scheduler = Scheduler(run_job, workers=args.workers, engine_concurrency=args.engine_concurrency, engine_interval=args.engine_interval,
+                          yield_tracker=yield_tracker, low_yield=args.low_yield)
+    jobs = get_jobs(args, queries, dirnames)
+    if args.resume:
+        todo = [job for job in jobs if journal.state(job) != "done"]
+        logging.info(f"Resuming: {len(jobs) - len(todo)} of {len(jobs)} jobs already done")
+        jobs = todo
+    try:
+        scheduler.run(jobs)
+    finally:
+        driver_pool.close()
+        downloader.close()
+        url_index.close()
+        journal.close()
+        metrics.log_summary()
+        if args.metrics_dir:
+            metrics.write_prometheus(os.path.join(args.metrics_dir, "metrics.prom"))
+            logging.info(f"metrics written to {args.metrics_dir}")
+        metrics.close()
 
 
 if __name__ == "__main__":
-    main(args)
+    if args.profile:
+        with profile(args.profile):
+            main(args)
+    else:
+        main(args)
@@ -3,16 +3,21 @@ from pathlib import Path
 from random import randint
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.wait import WebDriverWait
 import yaml
 
-from Download.image_scraper import ImageScraper
+from Download.driver_pool import WebDriverPool
+from Download.image_scraper import ImageScraper, USER_AGENT
 
 class PDFScraper(ImageScraper):
     def __init__(self, *args, **kwargs):
         self.search_engine = None
         super().__init__(*args, **kwargs)
 
-scraper = PDFScraper(query="test", save_img_dir="test", index=None, num_of_images=None, run_headless=False)
+driver_pool = WebDriverPool(USER_AGENT, headless=False)
+scraper = PDFScraper(query="test", save_img_dir="test", index=None, num_of_images=None, run_headless=False, driver_pool=driver_pool)
+scraper.driver = driver_pool.acquire()
+scraper.wait = WebDriverWait(scraper.driver, timeout=5)
 
 url = "https://learn.lingoda.com/en/login"
 
@@ -78,8 +83,8 @@ for course in total_course_list:
         scraper.wait.until(expected_conditions.visibility_of_element_located((By.CSS_SELECTOR, download_button_tag)))
         download = scraper.driver.find_element(By.CSS_SELECTOR, download_button_tag)
         pdf_file_name = save_base_path/f"{course_level}/{lesson_name}.pdf"
-        scraper.get_image(download.get_property("href"), pdf_file_name)
+        scraper.get_image(download.get_property("href"), pdf_file_name, validate=False)
         print(f"{index + 1}. {pdf_file_name} saved Successfully!")
 
-scraper.driver.delete_all_cookies()
-scraper.driver.close()
+driver_pool.release(scraper.driver)
+driver_pool.close()
@@ -1,5 +1,3 @@
 #!/bin/bash
-while IFS='' read -r line || [ -n "$line" ]; do
-	echo "started expanding :" $line
-	python ./Query\ Expansion/getexp.py "$line" >> expanded_queries.txt
-done < "$1"
+# all the queries are expanded by a single process, reusing its connections and browsers
+python ./Query\ Expansion/getexp.py --queries "$1" --output expanded_queries.txt "${@:2}"